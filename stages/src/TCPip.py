@@ -12,6 +12,9 @@ import logging
 import asyncio
 from asyncio.exceptions import IncompleteReadError
 
+import binaryProtocol
+from backgroundTasks import spawn
+
 class TCPServer():
     def __init__(self, hostname, port):
         self.logger = logging.getLogger('stages')
@@ -51,10 +54,15 @@ class TCPServer():
                     
                     if message.lower() == 'q\r\n':
                         cmdLoopCheck = False
-                        asyncio.create_task(self.enqueue_xmit((writer, 'closing connection...\n')))
+                        spawn(self.enqueue_xmit((writer, 'closing connection...\n')))
                         await asyncio.sleep(0.001)
+                    elif message.strip().lower() == 'binary':
+                        # switch this connection to binary frames for good
+                        await self.enqueue_xmit((writer, 'OK,binary\n'))
+                        await self.binary_loop(reader, writer, addr)
+                        cmdLoopCheck = False
                     else:
-                        asyncio.create_task(self.enqueue_cmd((writer, message)))
+                        await self.enqueue_cmd((writer, message))
                         await writer.drain()
 
             except IncompleteReadError as e3:
@@ -71,6 +79,31 @@ class TCPServer():
             await writer.drain()
             writer.close()
 
+    async def binary_loop(self, reader, writer, addr):
+        """
+        Reads binary protocol frames (see binaryProtocol.py) from a client
+        and passes the decoded requests to the Command Queue.
+        """
+        self.logger.info(f'binary mode: {addr!r}')
+
+        while not writer.is_closing():
+            try:
+                body = await binaryProtocol.read_frame(reader)
+            except IncompleteReadError as e:
+                self.logger.error(f'Warning: peer disconnected')
+                break
+
+            try:
+                request = binaryProtocol.unpack_request(body)
+            except ValueError as e:
+                self.logger.error(f'BAD,command failure: {e} from {addr!r}')
+                rejected = binaryProtocol.reject_request(body)
+                if rejected is not None:
+                    await self.enqueue_xmit((writer, rejected))
+                continue
+
+            await self.enqueue_cmd((writer, request))
+
     async def enqueue_cmd(self, message):
         await self.qCmd.put(message)
 
@@ -3,52 +3,162 @@
 # Aidan Gray
 # aidan.gray@idg.jhu.edu
 #
-# The UDP Broadcast Loop. The Command Handler puts messages on the qUDP queue,
-# which are then broadcast on the given ip (which is set in main.py and should
-# end in 255, ie. 192.168.1.255).
+# The UDP Broadcast Loop. It periodically broadcasts the position and move
+# state of every axis, taken from the Status Poller's snapshots, on the
+# given ip (which is set in main.py and should end in 255, ie.
+# 192.168.1.255). Each datagram is a packed binary telemetry frame:
+#
+#   header:   magic 'STUF', version (u8), axis count (u8),
+#             sequence number (u32), send time (f64, unix seconds)
+#   per axis: axis name (1 char), state (u8), sample time (f64),
+#             encoder position (i64, steps), position (f64, real units),
+#             speed (f64, steps/s)
+#
+# All fields are little-endian. unpack_telemetry() decodes a frame.
 
 import asyncio
 import logging
 import socket
+import struct
+import time
 from typing import Tuple, Union, Text
 
 Address = Tuple[str, int]
 
+TELEMETRY_MAGIC = b'STUF'
+TELEMETRY_VERSION = 1
+TELEMETRY_HEADER = struct.Struct('<4sBBId')
+TELEMETRY_AXIS = struct.Struct('<cBdqdd')
+
+STATE_IDLE = 0
+STATE_BUSY = 1
+STATE_NO_DATA = 255
+
+def pack_telemetry(seq, axisRecords):
+    """
+    Packs one telemetry frame.
+
+    Input:
+    - seq           Sequence number of the frame
+    - axisRecords   List of (name, state, time, encPosition, position, speed)
+
+    Output:
+    - The datagram as bytes
+    """
+    frame = [TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION,
+                                   len(axisRecords), seq & 0xFFFFFFFF, time.time())]
+    for name, state, sampleTime, encPosition, position, speed in axisRecords:
+        frame.append(TELEMETRY_AXIS.pack(name.encode(), state, sampleTime,
+                                         encPosition, position, speed))
+    return b''.join(frame)
+
+def unpack_telemetry(data):
+    """
+    Decodes one telemetry frame.
+
+    Output:
+    - seq           Sequence number of the frame
+    - sendTime      Time the frame was sent
+    - axisRecords   List of (name, state, time, encPosition, position, speed)
+    """
+    magic, version, count, seq, sendTime = TELEMETRY_HEADER.unpack_from(data)
+    if magic != TELEMETRY_MAGIC or version != TELEMETRY_VERSION:
+        raise ValueError(f'not a version {TELEMETRY_VERSION} telemetry frame')
+
+    axisRecords = []
+    for i in range(count):
+        record = TELEMETRY_AXIS.unpack_from(data, TELEMETRY_HEADER.size + i*TELEMETRY_AXIS.size)
+        axisRecords.append((record[0].decode(),) + record[1:])
+    return seq, sendTime, axisRecords
+
 class BroadcastProtocol(asyncio.DatagramProtocol):
 
-    def __init__(self, qUDP, target: Address, *, loop: asyncio.AbstractEventLoop = None):
+    def __init__(self, target: Address):
         self.logger = logging.getLogger('stages')
-        self.qUDP = qUDP
         self.target = target
-        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.transport = None
 
     def connection_made(self, transport: asyncio.transports.DatagramTransport):
         self.transport = transport
         sock = transport.get_extra_info("socket")  # type: socket.socket
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.broadcast()
 
     def datagram_received(self, data: Union[bytes, Text], addr: Address):
         #self.logger.info(f'data received: {data} {addr}')
         pass
 
-    def broadcast(self):
-        if not self.qUDP.empty():
-            msg = self.qUDP.get()  
-            #self.logger.info(f'sending {msg} to {self.target}')
-            self.transport.sendto(msg.encode(), self.target)
-        self.loop.call_soon(self.broadcast)
+    def broadcast(self, msg: bytes):
+        self.transport.sendto(msg, self.target)
 
 class UDPcast:
-    def __init__(self, hostname, port, qUDP):
+    def __init__(self, hostname, port, axes, poller, rate, onChange=False, heartbeat=1.0):
+        """
+        Input:
+        - axes      dict of axis name -> Stage
+        - poller    StatusPoller supplying the snapshots
+        - rate      Frames per second
+        - onChange  Only send when a state or position changed (plus a
+                    frame every heartbeat seconds)
+        """
+        self.logger = logging.getLogger('stages')
         self.hostname = hostname
         self.port = port
-        self.qUDP = qUDP
+        self.axes = axes
+        self.poller = poller
+        self.period = 1 / rate
+        self.onChange = onChange
+        self.heartbeat = heartbeat
+        self.seq = 0
 
     async def start(self):
+        """
+        Broadcasts until cancelled. If the port cannot be bound (ie. another
+        server is running), the error is logged and the server carries on
+        without telemetry.
+        """
         loop = asyncio.get_event_loop()
-        udpTask = loop.create_datagram_endpoint(
-                lambda: BroadcastProtocol(self.qUDP, (self.hostname, self.port), loop=loop), 
-                local_addr=('0.0.0.0', self.port))
-        await udpTask
\ No newline at end of file
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(
+                    lambda: BroadcastProtocol((self.hostname, self.port)),
+                    local_addr=('0.0.0.0', self.port))
+        except OSError as e:
+            self.logger.error(f'no UDP telemetry, cannot bind port {self.port}: {e}')
+            return
+
+        lastKey = None
+        lastSent = 0
+        try:
+            while True:
+                axisRecords = self.axis_records()
+                key = [record[1:2] + record[3:5] for record in axisRecords]
+                now = loop.time()
+
+                if not self.onChange or key != lastKey or now - lastSent >= self.heartbeat:
+                    protocol.broadcast(pack_telemetry(self.seq, axisRecords))
+                    self.seq += 1
+                    lastKey = key
+                    lastSent = now
+
+                await asyncio.sleep(self.period)
+        finally:
+            transport.close()
+
+    def axis_records(self):
+        """
+        Returns the telemetry record of every axis from the latest snapshots.
+        """
+        axisRecords = []
+        for name, stage in self.axes.items():
+            stageStatus = self.poller.latest(stage) if stage else None
+
+            if stageStatus is None:
+                axisRecords.append((name, STATE_NO_DATA, 0.0, 0, 0.0, 0.0))
+            else:
+                if stageStatus.moveState == 'BUSY':
+                    state = STATE_BUSY
+                else:
+                    state = STATE_IDLE
+                axisRecords.append((name, state, stageStatus.time, stageStatus.encPosition,
+                                    stageStatus.position, stageStatus.speed))
+        return axisRecords
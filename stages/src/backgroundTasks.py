@@ -0,0 +1,29 @@
+# backgroundTasks.py
+#
+# Fire-and-forget tasks (replies, events, stops sent ahead of the lanes).
+# The event loop only keeps weak references to tasks, so one nobody holds
+# can be garbage collected before it is done. spawn() keeps every task
+# until it finishes and logs any exception it ends with, which would
+# otherwise go unseen.
+
+import logging
+import asyncio
+
+tasks = set()
+
+def spawn(coro):
+    """
+    Runs a coroutine as a task that is kept until it is done.
+
+    Output:
+    - the Task
+    """
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(task_done)
+    return task
+
+def task_done(task):
+    tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.getLogger('stages').error(f'background task failed: {task.exception()!r}')
@@ -0,0 +1,105 @@
+#!/usr/local/bin/python3.8
+# benchDispatch.py
+#
+# Measures the idle CPU use and command latency of the Command Handler loop,
+# comparing the old busy-poll dispatcher with the queue-waiting one. No
+# hardware is needed: the latency test sends a command that is rejected by
+# the parser, so only the dispatch path is timed.
+
+import asyncio
+import logging
+import sys
+import time
+import argparse
+import shlex
+import statistics
+
+from cmdHandler import CMDLoop
+from statusPoller import StatusPoller
+
+class BusyPollLoop(CMDLoop):
+    """
+    The original dispatcher, kept here for comparison only.
+    """
+    async def start(self):
+        while True:
+            if not self.qCmd.empty():
+                msg = await self.qCmd.get()
+                if msg is None:
+                    break
+                retData = await self.parse_raw_command(msg[1])
+                await self.enqueue_xmit((msg[0], retData+'\n'))
+            await asyncio.sleep(0.000001)
+
+async def measure_idle(loopClass, duration):
+    """
+    Returns the CPU time used per wall second while no commands arrive.
+    """
+    cmdLoop = loopClass(asyncio.Queue(), asyncio.Queue(), ['','','',''], StatusPoller([], 10))
+    task = asyncio.create_task(cmdLoop.start())
+    await asyncio.sleep(0.1)
+
+    cpuStart = time.process_time()
+    wallStart = time.perf_counter()
+    await asyncio.sleep(duration)
+    cpuUsed = time.process_time() - cpuStart
+    wallUsed = time.perf_counter() - wallStart
+
+    cmdLoop.stop()
+    await task
+    return cpuUsed / wallUsed
+
+async def measure_latency(loopClass, count):
+    """
+    Returns the round trip times (s) of count commands sent one at a time.
+    """
+    qCmd = asyncio.Queue()
+    qXmit = asyncio.Queue()
+    cmdLoop = loopClass(qCmd, qXmit, ['','','',''], StatusPoller([], 10))
+    task = asyncio.create_task(cmdLoop.start())
+
+    latencies = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        await qCmd.put((None, 'bench\n'))
+        await qXmit.get()
+        latencies.append(time.perf_counter() - t0)
+
+    cmdLoop.stop()
+    await task
+    return latencies
+
+def report(log, name, idle, latencies):
+    latencies = sorted(latencies)
+    p99 = latencies[int(0.99 * (len(latencies) - 1))]
+    log.info(f'{name:10s} idle CPU = {100*idle:6.2f}%  '
+             f'latency median = {1e6*statistics.median(latencies):8.1f}us  '
+             f'p99 = {1e6*p99:8.1f}us')
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+
+    parser = argparse.ArgumentParser(sys.argv[0])
+    parser.add_argument('--idleTime', type=float, default=3.0,
+                        help='seconds to sample idle CPU use for')
+    parser.add_argument('--count', type=int, default=5000,
+                        help='number of commands to time')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(datefmt = "%Y-%m-%d %H:%M:%S",
+                        format = "%(asctime)s.%(msecs)03dZ %(name)-10s %(levelno)s %(filename)s:%(lineno)d %(message)s")
+    log = logging.getLogger('bench')
+    log.setLevel(logging.INFO)
+    # the parser logs every rejected command
+    logging.getLogger('stages').setLevel(logging.CRITICAL)
+
+    for name, loopClass in (('busy-poll', BusyPollLoop), ('queue-wait', CMDLoop)):
+        idle = asyncio.run(measure_idle(loopClass, opts.idleTime))
+        latencies = asyncio.run(measure_latency(loopClass, opts.count))
+        report(log, name, idle, latencies)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/local/bin/python3.8
+# benchStages.py
+#
+# Load test for the STUF stage server. Opens many concurrent clients,
+# replays a mix of commands and reports the throughput and latency
+# percentiles. With --spawn it first starts main.py on libximc virtual
+# controllers (xi-emu), so it runs on a machine with no stages attached:
+#
+#   ./benchStages.py --spawn --mix mixed --clients 16 --duration 10
+#
+# --maxP99 and --minRate make it exit with an error when the result is
+# worse, for use as a regression check.
+
+import asyncio
+import logging
+import sys
+import os
+import time
+import random
+import argparse
+import shlex
+import json
+import signal
+import tempfile
+import subprocess
+
+# soft stops of axes a-d, as set in main.py
+AXIS_RANGES = {'a': (-180, 0), 'b': (-45, 45), 'c': (0, 100), 'd': (0, 180)}
+
+# command mixes: (command, weight)
+MIXES = {
+    'status': [('status', 90), ('state', 5), ('goto', 5)],
+    'goto':   [('goto', 70), ('offset', 10), ('status', 20)],
+    'mixed':  [('status', 40), ('state', 20), ('goto', 30), ('offset', 10)],
+}
+
+# reply lines per command (status is asked for one axis at a time)
+REPLY_LINES = {'status': 2, 'state': 1, 'goto': 1, 'offset': 1}
+
+def make_cmd(rng, name):
+    """
+    Returns a random command string of the given type
+    """
+    axis = rng.choice('abcd')
+    low, high = AXIS_RANGES[axis]
+    if name == 'status':
+        return f'status,{axis}'
+    elif name == 'state':
+        return 'state'
+    elif name == 'goto':
+        return f'goto,{axis}={rng.uniform(low, high):.3f}'
+    elif name == 'offset':
+        return f'offset,{axis}={rng.uniform(-1, 1):.3f}'
+
+def percentile(sortedValues, pct):
+    if len(sortedValues) == 0:
+        return float('nan')
+    return sortedValues[min(len(sortedValues) - 1, int(pct / 100 * len(sortedValues)))]
+
+async def run_client(opts, clientId, deadline, latencies):
+    """
+    One client: keeps opts.depth tagged commands in flight until deadline,
+    recording (command, latency) for every reply.
+    """
+    rng = random.Random(opts.seed + clientId)
+    names = [name for name, weight in MIXES[opts.mix]]
+    weights = [weight for name, weight in MIXES[opts.mix]]
+
+    reader, writer = await asyncio.open_connection(opts.host, opts.port)
+    inFlight = {}
+    slots = asyncio.Semaphore(opts.depth)
+
+    async def read_replies():
+        while True:
+            line = (await reader.readuntil(b'\n')).decode()
+            tag = line.partition(',')[0]
+            if tag not in inFlight:
+                continue
+            name, sentTime, linesLeft = inFlight[tag]
+            if linesLeft > 1:
+                inFlight[tag] = (name, sentTime, linesLeft - 1)
+            else:
+                del inFlight[tag]
+                latencies.append((name, time.perf_counter() - sentTime))
+                slots.release()
+
+    readTask = asyncio.create_task(read_replies())
+    n = 0
+    while time.perf_counter() < deadline:
+        await slots.acquire()
+        name = rng.choices(names, weights)[0]
+        tag = f'#{clientId}.{n}'
+        n += 1
+        inFlight[tag] = (name, time.perf_counter(), REPLY_LINES[name])
+        writer.write(f'{tag},{make_cmd(rng, name)}\r\n'.encode())
+        await writer.drain()
+
+    # let the last replies arrive
+    try:
+        await asyncio.wait_for(slots.acquire(), 5)
+        for i in range(opts.depth - 1):
+            await asyncio.wait_for(slots.acquire(), 5)
+    except asyncio.TimeoutError:
+        pass
+
+    readTask.cancel()
+    writer.close()
+
+async def run_load(opts):
+    latencies = []
+    startTime = time.perf_counter()
+    deadline = startTime + opts.duration
+    await asyncio.gather(*[run_client(opts, i, deadline, latencies) for i in range(opts.clients)])
+    return latencies, time.perf_counter() - startTime
+
+def summarize(latencies, elapsed):
+    """
+    Returns the throughput and latency percentiles (ms), overall and per
+    command type.
+    """
+    result = {'commands': len(latencies), 'seconds': elapsed, 'rate': len(latencies) / elapsed}
+    groups = {'all': [lat for name, lat in latencies]}
+    for name, lat in latencies:
+        groups.setdefault(name, []).append(lat)
+
+    for name, values in groups.items():
+        values.sort()
+        result[name] = {'count': len(values),
+                        'p50': 1000 * percentile(values, 50),
+                        'p95': 1000 * percentile(values, 95),
+                        'p99': 1000 * percentile(values, 99)}
+    return result
+
+def spawn_server(opts, log):
+    """
+    Starts main.py on virtual controllers and waits until it accepts
+    connections.
+    """
+    virtualDir = opts.virtualDir or tempfile.mkdtemp(prefix='stuf-xi-emu-')
+    mainPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    cmd = [sys.executable, mainPath, '--virtual', virtualDir, '--interface', opts.interface,
+           '--port', str(opts.port), '--udpPort', str(opts.udpPort), '--logLevel', '30']
+    log.info(f'starting server: {" ".join(cmd)}')
+    server = subprocess.Popen(cmd)
+
+    async def wait_ready():
+        for i in range(100):
+            try:
+                reader, writer = await asyncio.open_connection(opts.host, opts.port)
+                writer.close()
+                return True
+            except OSError:
+                if server.poll() is not None:
+                    return False
+                await asyncio.sleep(0.1)
+        return False
+
+    if not asyncio.run(wait_ready()):
+        server.kill()
+        raise RuntimeError('server did not start')
+    return server
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+
+    parser = argparse.ArgumentParser(sys.argv[0])
+    parser.add_argument('--logLevel', type=int, default=logging.INFO,
+                        help='logging threshold. 10=debug, 20=info, 30=warn')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='the IP address to connect to')
+    parser.add_argument('--port', type=int, default=1024,
+                        help='the TCP port to connect to')
+    parser.add_argument('--mix', type=str, default='mixed', choices=sorted(MIXES),
+                        help='command mix to replay')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='number of concurrent clients')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='commands each client keeps in flight (1 = lock-step)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run for')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the command stream')
+    parser.add_argument('--spawn', action='store_true',
+                        help='start main.py on virtual (xi-emu) controllers first')
+    parser.add_argument('--interface', type=str, default='lo',
+                        help='network interface for the spawned server')
+    parser.add_argument('--udpPort', type=int, default=8889,
+                        help='UDP telemetry port of the spawned server, apart from that of a running server')
+    parser.add_argument('--virtualDir', type=str, default=None,
+                        help='directory for the virtual controller files of the spawned server')
+    parser.add_argument('--json', type=str, default=None,
+                        help='also write the results to this file')
+    parser.add_argument('--maxP99', type=float, default=None,
+                        help='fail if the overall p99 latency (ms) is above this')
+    parser.add_argument('--minRate', type=float, default=None,
+                        help='fail if the throughput (commands/s) is below this')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(datefmt = "%Y-%m-%d %H:%M:%S",
+                        format = "%(asctime)s.%(msecs)03dZ %(name)-10s %(levelno)s %(filename)s:%(lineno)d %(message)s")
+    log = logging.getLogger('bench')
+    log.setLevel(opts.logLevel)
+
+    server = spawn_server(opts, log) if opts.spawn else None
+    try:
+        latencies, elapsed = asyncio.run(run_load(opts))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait(10)
+
+    result = summarize(latencies, elapsed)
+    log.info(f'{opts.mix} mix, {opts.clients} clients, depth {opts.depth}: '
+             f'{result["commands"]} commands in {elapsed:.1f}s = {result["rate"]:.1f} cmd/s')
+    for name in ['all'] + sorted(REPLY_LINES):
+        if name in result:
+            r = result[name]
+            log.info(f'  {name:7s} n={r["count"]:7d}  p50={r["p50"]:8.3f}ms  '
+                     f'p95={r["p95"]:8.3f}ms  p99={r["p99"]:8.3f}ms')
+
+    if opts.json is not None:
+        with open(opts.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if opts.maxP99 is not None and result['all']['p99'] > opts.maxP99:
+        log.error(f'p99 latency {result["all"]["p99"]:.3f}ms is above {opts.maxP99}ms')
+        failed = True
+    if opts.minRate is not None and result['rate'] < opts.minRate:
+        log.error(f'throughput {result["rate"]:.1f} cmd/s is below {opts.minRate}')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
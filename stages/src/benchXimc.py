@@ -0,0 +1,86 @@
+#!/usr/local/bin/python3.8
+# benchXimc.py
+#
+# Microbenchmark of the per-call overhead of libximc through ctypes, with
+# and without the prototypes from ximcPrototypes.py. It runs on a libximc
+# virtual controller (xi-emu), so no stage is needed:
+#
+#   ./benchXimc.py --calls 100000
+#
+# For each call it reports the time per call:
+# - plain      a function object with no argtypes/restype, as pyximc leaves them
+# - declared   lib.<name> after ximcPrototypes.declare(lib), with its
+#              prototype, as Stage calls it
+
+import os
+import sys
+import time
+import logging
+import argparse
+import shlex
+import tempfile
+from ctypes import *
+
+import ximcPath
+from pyximc import *
+import ximcPrototypes
+
+def time_calls(func, args, calls):
+    """
+    Returns the time (ns) per call of func(*args)
+    """
+    startTime = time.perf_counter()
+    for i in range(calls):
+        func(*args)
+    return 1e9 * (time.perf_counter() - startTime) / calls
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+
+    parser = argparse.ArgumentParser(sys.argv[0])
+    parser.add_argument('--logLevel', type=int, default=logging.INFO,
+                        help='logging threshold. 10=debug, 20=info, 30=warn')
+    parser.add_argument('--calls', type=int, default=100000,
+                        help='calls to time per function and mode')
+    parser.add_argument('--virtual', type=str, default=None, metavar='FILE',
+                        help='file for the virtual controller state (default: a temporary file)')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(datefmt = "%Y-%m-%d %H:%M:%S",
+                        format = "%(asctime)s.%(msecs)03dZ %(name)-10s %(levelno)s %(filename)s:%(lineno)d %(message)s")
+    log = logging.getLogger('bench')
+    log.setLevel(opts.logLevel)
+
+    path = opts.virtual or os.path.join(tempfile.mkdtemp(prefix='stuf-xi-emu-'), 'bench.bin')
+    uri = f'xi-emu://{os.path.abspath(path)}'.encode()
+
+    # undeclared function objects, made before declare() changes lib's
+    plain = {name: lib._FuncPtr((name, lib)) for name in ('get_status', 'get_position', 'get_move_settings')}
+    ximcPrototypes.declare(lib)
+
+    dev = lib.open_device(uri)
+    if dev <= 0:
+        log.error(f'could not open {uri!r}')
+        sys.exit(1)
+
+    status = status_t()
+    position = get_position_t()
+    mvst = move_settings_t()
+    cases = [('get_status', (dev, byref(status))),
+             ('get_position', (dev, byref(position))),
+             ('get_move_settings', (dev, byref(mvst)))]
+
+    log.info(f'{opts.calls} calls each on {uri!r}')
+    for name, args in cases:
+        plainNs = time_calls(plain[name], args, opts.calls)
+        declaredNs = time_calls(getattr(lib, name), args, opts.calls)
+        log.info(f'  {name:18s} plain={plainNs:8.0f}ns  declared={declaredNs:8.0f}ns  '
+                 f'({100 * (declaredNs - plainNs) / plainNs:+.1f}%)')
+
+    lib.close_device(byref(c_int(dev)))
+
+if __name__ == "__main__":
+    main()
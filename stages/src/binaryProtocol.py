@@ -0,0 +1,139 @@
+# binaryProtocol.py
+#
+# Compact binary framing for the stage TCP server. A client switches a
+# connection to this mode by sending the text line 'binary'; the server
+# answers 'OK,binary' and every message after that is a frame:
+#
+#   frame:    length (u16, bytes that follow) + body
+#   request:  opcode (u8), tag (u16), axis mask (u8), flags (u8),
+#             then one f64 per axis in the mask for GOTO/OFFSET
+#   reply:    opcode (u8), tag (u16), result (u8), axis mask (u8),
+#             then per axis in the mask:
+#               STATUS/WAIT     state (u8) + position (f64, real units)
+#               GOTO/OFFSET/STOP result (u8)
+#
+# A WAIT reply is only sent once every axis in the mask has finished the
+# commands sent to it before the WAIT and is IDLE.
+#
+# A request that is rejected outright (unknown opcode or axis, or a
+# malformed body after a readable header) gets a BAD reply with an empty
+# axis mask and no per-axis records. A frame too short to hold a header
+# has no tag to answer to, and is dropped.
+#
+# The axis mask has bit 0 for axis a through bit 3 for axis d. A STATUS
+# or WAIT request with an empty mask means all axes. The tag is copied into the
+# reply so a client can match replies to requests. All fields are
+# little-endian.
+
+import struct
+from collections import namedtuple
+
+OP_GOTO = 1
+OP_OFFSET = 2
+OP_STATUS = 3
+OP_STOP = 4
+OP_WAIT = 5
+
+FLAG_FRESH = 0x01
+
+RESULT_OK = 0
+RESULT_BAD = 1
+
+STATE_IDLE = 0
+STATE_BUSY = 1
+STATE_BAD = 255
+
+LENGTH = struct.Struct('<H')
+REQUEST_HEADER = struct.Struct('<BHBB')
+REPLY_HEADER = struct.Struct('<BHBB')
+AXIS_VALUE = struct.Struct('<d')
+AXIS_STATUS = struct.Struct('<Bd')
+AXIS_RESULT = struct.Struct('<B')
+
+BinaryRequest = namedtuple('BinaryRequest', ['opcode', 'tag', 'axisMask', 'flags', 'values'])
+BinaryReply = namedtuple('BinaryReply', ['opcode', 'tag', 'result', 'axisMask', 'records'])
+
+def mask_axes(axisMask):
+    """
+    Returns the axis indices (0=a .. 3=d) set in an axis mask
+    """
+    return [i for i in range(4) if axisMask & (1 << i)]
+
+def axes_mask(indices):
+    """
+    Returns the axis mask for a list of axis indices
+    """
+    axisMask = 0
+    for i in indices:
+        axisMask |= 1 << i
+    return axisMask
+
+async def read_frame(reader):
+    """
+    Reads one frame from a StreamReader and returns its body.
+    """
+    length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    return await reader.readexactly(length)
+
+def pack_request(opcode, tag, axisMask, flags=0, values=()):
+    """
+    Packs a request frame, length prefix included.
+    """
+    body = REQUEST_HEADER.pack(opcode, tag, axisMask, flags)
+    body += b''.join(AXIS_VALUE.pack(val) for val in values)
+    return LENGTH.pack(len(body)) + body
+
+def unpack_request(body):
+    """
+    Decodes the body of a request frame. Raises ValueError if it is malformed.
+    """
+    try:
+        opcode, tag, axisMask, flags = REQUEST_HEADER.unpack_from(body)
+        values = []
+        if opcode == OP_GOTO or opcode == OP_OFFSET:
+            for n in range(len(mask_axes(axisMask))):
+                values.append(AXIS_VALUE.unpack_from(body, REQUEST_HEADER.size + n*AXIS_VALUE.size)[0])
+    except struct.error as e:
+        raise ValueError(f'malformed request frame: {e}')
+
+    return BinaryRequest(opcode, tag, axisMask, flags, values)
+
+def reject_request(body):
+    """
+    Returns the BAD reply frame to a malformed request, or None if the
+    header (and so the tag) cannot be read.
+    """
+    try:
+        opcode, tag, axisMask, flags = REQUEST_HEADER.unpack_from(body)
+    except struct.error:
+        return None
+    return pack_reply(opcode, tag, RESULT_BAD, 0)
+
+def pack_reply(opcode, tag, result, axisMask, records=()):
+    """
+    Packs a reply frame, length prefix included. records holds one entry
+    per axis in the mask: (state, position) for STATUS/WAIT, result otherwise.
+    """
+    body = REPLY_HEADER.pack(opcode, tag, result, axisMask)
+    if opcode == OP_STATUS or opcode == OP_WAIT:
+        body += b''.join(AXIS_STATUS.pack(*record) for record in records)
+    else:
+        body += b''.join(AXIS_RESULT.pack(record) for record in records)
+    return LENGTH.pack(len(body)) + body
+
+def unpack_reply(body):
+    """
+    Decodes the body of a reply frame.
+    """
+    opcode, tag, result, axisMask = REPLY_HEADER.unpack_from(body)
+    records = []
+    offset = REPLY_HEADER.size
+    for n in range(len(mask_axes(axisMask))):
+        if opcode == OP_STATUS or opcode == OP_WAIT:
+            records.append(AXIS_STATUS.unpack_from(body, offset))
+            offset += AXIS_STATUS.size
+        else:
+            records.append(AXIS_RESULT.unpack_from(body, offset)[0])
+            offset += AXIS_RESULT.size
+
+    return BinaryReply(opcode, tag, result, axisMask, records)
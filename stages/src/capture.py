@@ -0,0 +1,186 @@
+# capture.py
+#
+# High-rate motion capture from the controllers' measurement buffer. Once
+# started, a controller samples its speed and following error every 1 ms
+# into a 25 point buffer (measurements_t). A capture drains that buffer
+# every 20 ms (every 5 ms while it comes back nearly full) into a NumPy
+# ring buffer per axis, so settling and following error can be studied
+# without polling positions over USB.
+#
+#   capture,<axis>,start[,<seconds>]    starts capturing, for <seconds> or
+#                                       until stopped. Earlier data is
+#                                       cleared. The reply comes once the
+#                                       controller has started measuring
+#   capture,<axis>,stop                 stops capturing, keeping the data
+#   capture,<axis>,status               OK,RUNNING,<samples>, OK,IDLE,<samples>
+#                                       or, if reading the buffer failed,
+#                                       OK,FAILED,<samples>,<reason>
+#   capture,<axis>,dump[,<n>]           OK,<samples> followed by one
+#                                       'time,speed,error' line per sample,
+#                                       the last <n> only if given
+#
+# Each drain reads the measurements_t straight into the same one-row
+# record array (see ximcDtypes.py and Stage.read_measurements_record), so
+# the loop allocates little per read.
+#
+# Times are time.time() at each sample, estimated from the read time and
+# the 1 ms sample period. Speed and error are in microsteps (or encoder
+# counts) per second, as the controller reports them.
+#
+# A dump can run to 600000 lines, so it is formatted a column at a time
+# with NumPy, on a worker thread rather than the event loop.
+
+import logging
+import asyncio
+import time
+import numpy as np
+
+from ringBuffer import RingBuffer
+from ximcDtypes import MEASUREMENTS_RECORD_DTYPE
+
+CAPTURE_DTYPE = np.dtype([('time', 'f8'), ('speed', 'i4'), ('error', 'i4')])
+
+# controller sample period (s) and measurement buffer length
+SAMPLE_PERIOD = 0.001
+MEASUREMENTS_LENGTH = 25
+
+def format_samples(samples):
+    """
+    Returns the 'time,speed,error' lines of a CAPTURE_DTYPE array, joined
+    by newlines. Times are given to the microsecond.
+    """
+    seconds = np.floor(samples['time']).astype(np.int64)
+    micros = np.rint((samples['time'] - seconds) * 1e6).astype(np.int64)
+    carry = micros >= 1000000
+    seconds[carry] += 1
+    micros[carry] -= 1000000
+
+    lines = np.char.add(seconds.astype(str), '.')
+    for column in (np.char.zfill(micros.astype(str), 6), ',', samples['speed'].astype(str),
+                   ',', samples['error'].astype(str)):
+        lines = np.char.add(lines, column)
+    return '\n'.join(lines.tolist())
+
+class AxisCapture:
+    """
+    The ring buffer and draining task of one axis
+    """
+    def __init__(self, size):
+        self.buffer = RingBuffer(size, CAPTURE_DTYPE)
+        self.task = None
+        self.error = None  # why the last capture failed, if it did
+
+        # read buffers, reused on every drain
+        self.meas = np.zeros(1, dtype=MEASUREMENTS_RECORD_DTYPE)
+        self.records = np.zeros(MEASUREMENTS_LENGTH, dtype=CAPTURE_DTYPE)
+        self.ages = SAMPLE_PERIOD * np.arange(MEASUREMENTS_LENGTH - 1, -1, -1)
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+class Capture:
+    def __init__(self, axes, size=600000, drainInterval=0.02, fastInterval=0.005):
+        """
+        Input:
+        - axes          dict of axis name -> Stage
+        - size          samples kept per axis (600000 = 10 minutes)
+        - drainInterval seconds between reads of the measurement buffer
+        - fastInterval  seconds between reads while it is nearly full
+        """
+        self.logger = logging.getLogger('stages')
+        self.axes = axes
+        self.size = size
+        self.drainInterval = drainInterval
+        self.fastInterval = fastInterval
+        self.captures = {}
+
+    async def command(self, args):
+        """
+        Handles the arguments of a 'capture' command.
+
+        Output:
+        - The reply string
+        """
+        if len(args) < 2:
+            return 'BAD, invalid capture command'
+
+        name = args[0]
+        stage = self.axes.get(name)
+        if not stage:
+            return 'BAD, invalid stage selection'
+        capture = self.captures.setdefault(name, AxisCapture(self.size))
+        subCmd = args[1]
+
+        try:
+            if subCmd == 'start' and len(args) <= 3:
+                duration = float(args[2]) if len(args) == 3 else None
+                if capture.running():
+                    return 'BAD, capture already running'
+                response = await stage.start_measurements_async()
+                if response != 'OK':
+                    return response
+                if capture.running():
+                    return 'BAD, capture already running'
+                capture.buffer.clear()
+                capture.error = None
+                capture.task = asyncio.create_task(self.drain(name, stage, capture, duration))
+                return 'OK'
+
+            elif subCmd == 'stop' and len(args) == 2:
+                if not capture.running():
+                    return 'BAD, no capture running'
+                capture.task.cancel()
+                return 'OK'
+
+            elif subCmd == 'status' and len(args) == 2:
+                if capture.running():
+                    return f'OK,RUNNING,{len(capture.buffer)}'
+                elif capture.error is not None:
+                    return f'OK,FAILED,{len(capture.buffer)},{capture.error}'
+                return f'OK,IDLE,{len(capture.buffer)}'
+
+            elif subCmd == 'dump' and len(args) <= 3:
+                samples = capture.buffer.array()
+                if len(args) == 3:
+                    samples = samples[max(0, len(samples) - int(args[2])):]
+                if len(samples) == 0:
+                    return 'OK,0'
+                lines = await asyncio.get_event_loop().run_in_executor(None, format_samples, samples)
+                return f'OK,{len(samples)}\n{lines}'
+
+        except ValueError as e:
+            return f'BAD, invalid capture command: {e}'
+
+        return 'BAD, invalid capture command'
+
+    async def drain(self, name, stage, capture, duration):
+        """
+        Moves the measurements of a controller that has been started into
+        the ring buffer until cancelled or duration has passed.
+        """
+        try:
+            startTime = time.time()
+            while duration is None or time.time() - startTime < duration:
+                response = await stage.read_measurements_record_async(capture.meas, 0)
+                if response != 'OK':
+                    raise RuntimeError(response)
+                meas = capture.meas[0]['measurements']
+
+                n = min(int(meas['Length']), MEASUREMENTS_LENGTH)
+                if n > 0:
+                    records = capture.records[:n]
+                    np.subtract(capture.meas[0]['time'], capture.ages[MEASUREMENTS_LENGTH - n:], out=records['time'])
+                    records['speed'] = meas['Speed'][:n]
+                    records['error'] = meas['Error'][:n]
+                    capture.buffer.extend(records)
+
+                if n >= MEASUREMENTS_LENGTH - 5:
+                    await asyncio.sleep(self.fastInterval)
+                else:
+                    await asyncio.sleep(self.drainInterval)
+
+            self.logger.info(f'{name}: capture done, {len(capture.buffer)} samples')
+
+        except Exception as e:
+            self.logger.error(f'{name}: capture failed: {e}')
+            capture.error = e
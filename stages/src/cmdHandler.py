@@ -4,318 +4,704 @@
 # aidan.gray@idg.jhu.edu
 #
 # Command Handler loop. Runs in parallel with the TCP Server and
-# Transmit loops. It constantly monitors the Command Queue and 
-# acts upon new commands in the order they are received.
+# Transmit loops. It waits on the Command Queue and hands the work for
+# each command to a lane per axis. Commands for the same axis run in the
+# order they are received; commands for different axes run concurrently.
+# The blocking libximc calls themselves run on each Stage's own thread.
+# Replies to untagged commands are sent in the order the commands came in
+# on their connection, as such clients match replies by order; tagged
+# (#<id>) and binary requests are replied to as soon as they are done.
 
 import logging
 import asyncio
+import functools
 import time
-import queue
+
+import binaryProtocol
+from transmitter import POLICIES
+from sequencer import Sequencer
+from streamer import Streamer
+from flyscan import FlyScanner
+from capture import Capture
+from syncMove import SyncMover
+from profileBundle import ProfileBundle
+from backgroundTasks import spawn
+
+AXIS_NAMES = ('a', 'b', 'c', 'd')
 
 class CMDLoop:
-    def __init__(self, qCmd, qXmit, openDevs):
+    def __init__(self, qCmd, qXmit, openDevs, poller, transmitter=None):
         self.log = logging.getLogger('stages')
         self.qCmd = qCmd
         self.qXmit = qXmit
-        self.qUDP = queue.Queue()
-        self.axis_a = openDevs[0]
-        self.axis_b = openDevs[1]
-        self.axis_c = openDevs[2]
-        self.axis_d = openDevs[3]
+        self.poller = poller
+        self.transmitter = transmitter
+        self.axes = dict(zip(AXIS_NAMES, openDevs))
+
+        # one lane (FIFO of pending jobs) per connected Stage
+        self.lanes = {}
+        for stage in self.axes.values():
+            if stage:
+                self.lanes[stage] = asyncio.Queue()
+
+        self.sequencer = Sequencer(self.axes, poller, self.submit)
+        self.streamer = Streamer(self.axes, poller, self.submit)
+        self.flyscanner = FlyScanner(self.axes, poller, self.submit)
+        self.capture = Capture(self.axes)
+        self.syncMover = SyncMover(poller, self.submit)
+        self.profiles = ProfileBundle()
+
+        # writer -> reply task of the last untagged command from it, which
+        # the next untagged reply waits for
+        self.lastReplies = {}
 
     async def start(self):
-        lastTime = 0
-        while True:
-            newTime = time.perf_counter()
-            # if lastTime == 0:
-            #     tempTime = newTime - 1
-
-            ### Check the Command Queue ###
-            if not self.qCmd.empty():
-                msg = await self.qCmd.get()
-                writer = msg[0]
-                cmd = msg[1]
+        """
+        Waits on the Command Queue and dispatches each command as it arrives.
+        Runs until stop() is called.
+        """
+        laneTasks = [asyncio.create_task(self.lane_loop(stage)) for stage in self.lanes]
 
-                retData = await self.parse_raw_command(cmd)
-                await self.enqueue_xmit((writer, retData+'\n'))
-
-            lastTime = newTime
-            await asyncio.sleep(0.000001)
+        while True:
+            msg = await self.qCmd.get()
+            if msg is None:
+                self.log.info('command loop stopped')
+                break
+
+            writer = msg[0]
+            cmd = msg[1]
+
+            # the axis work is queued before the next command is read, so
+            # per-axis order follows the order the commands arrived in
+            if isinstance(cmd, binaryProtocol.BinaryRequest):
+                pending = self.submit_binary(cmd)
+                spawn(self.reply(writer, pending))
+            elif cmd.strip().startswith('#'):
+                pending = self.submit_raw_command(cmd, writer)
+                spawn(self.reply(writer, pending))
+            else:
+                pending = self.submit_raw_command(cmd, writer)
+                task = spawn(self.reply(writer, pending, self.reply_kind(cmd), self.lastReplies.get(writer)))
+                self.lastReplies[writer] = task
+                task.add_done_callback(functools.partial(self.reply_sent, writer))
+
+        for lane in self.lanes.values():
+            lane.put_nowait(None)
+        await asyncio.gather(*laneTasks)
+
+    def stop(self):
+        """
+        Stops the command loop after any commands already queued are handled.
+        """
+        self.qCmd.put_nowait(None)
+
+    async def lane_loop(self, stage):
+        """
+        Runs the jobs queued for one Stage, one at a time, in order.
+        """
+        lane = self.lanes[stage]
+        while True:
+            job = await lane.get()
+            if job is None:
+                break
+
+            func, future = job
+            try:
+                result = await func()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def submit(self, stage, func, *args):
+        """
+        Queues the coroutine function func(*args) on the lane of the given
+        Stage.
+
+        Output:
+        - future    Resolves to the return value of func
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.lanes[stage].put_nowait((functools.partial(func, *args), future))
+        return future
+
+    async def reply(self, writer, pending, kind=None, previous=None):
+        """
+        Sends the reply to a command once it is ready and, if previous is
+        given, once the reply task previous is done.
+        """
+        retData = await pending
+        if previous is not None:
+            await asyncio.wait([previous])
+        if isinstance(retData, str):
+            retData += '\n'
+        await self.enqueue_xmit((writer, retData, kind))
+
+    def reply_sent(self, writer, task):
+        if self.lastReplies.get(writer) is task:
+            del self.lastReplies[writer]
+
+    def reply_kind(self, cmd):
+        """
+        Returns the kind of reply an untagged command gets, for the
+        Transmitter to coalesce: the command itself, ie. 'status,a', for
+        status and state queries, otherwise None. Tagged requests (and so
+        every binary one) are each waited on, so their replies are never
+        coalesced.
+        """
+        cmdStr = cmd.strip()
+        name = cmdStr.partition(',')[0]
+        if name == 'status' or name == 'state':
+            return cmdStr
+        return None
 
     async def parse_raw_command(self, rawCmd):
+        return await self.submit_raw_command(rawCmd)
+
+    def submit_raw_command(self, rawCmd, writer=None):
+        """
+        Splits a raw command and submits it. A command may start with a
+        request ID, ie. '#17,status,a', which is then put at the start of
+        every line of its reply ('#17,OK' '#17,a=IDLE, 0.0deg') and of any
+        events it sends later, so a client can keep several commands in
+        flight and match the replies, which may come back out of order.
+
+        Output:
+        - awaitable that resolves to the reply string
+        """
         cmdStr = rawCmd.strip()  # remove whitespace at the end
-        
+
+        tag = None
+        if cmdStr.startswith('#'):
+            tag, sep, cmdStr = cmdStr.partition(',')
+
         if len(cmdStr) != 0:
             # cmdStr = cmdStr.replace(' ', '')  # Remove all whitespace
             cmdStrList = cmdStr.split(',')  # split the command on the commas
-            retData = await self.execute_command(cmdStrList)
+            pending = self.submit_command(cmdStrList, writer, tag)
         else:
             retData = 'BAD,command failure: empty command'
             self.log.error(retData)
+            pending = self.reply_now(retData)
 
-        #if 'BAD' not in retData and 'OK' not in retData:
-        #    retData = 'OK,'+retData
+        if tag is not None:
+            pending = self.tag_reply(tag, pending)
+        return pending
 
-        return retData
+    async def tag_reply(self, tag, pending):
+        retData = await pending
+        return '\n'.join(f'{tag},{line}' for line in retData.split('\n'))
+
+    def notify(self, writer, tag, event):
+        """
+        Sends an asynchronous event line, ie. 'DONE,a,12.3', to a client.
+        """
+        if tag is not None:
+            event = f'{tag},{event}'
+        self.qXmit.put_nowait((writer, event+'\n'))
 
     async def execute_command(self, cmdStrList):
+        return await self.submit_command(cmdStrList)
+
+    def submit_command(self, cmdStrList, writer=None, tag=None):
+        """
+        Queues the axis work for a command on the lanes of the axes it
+        touches. Nothing is awaited here, so the work is queued in the order
+        submit_command() is called. Events the command produces after its
+        reply are sent to writer, with the request ID tag.
+
+        Output:
+        - awaitable that resolves to the reply string
+        """
         cmd = cmdStrList[0]
         args = cmdStrList[1:]
-        retData = 'OK'
+        notify = functools.partial(self.notify, writer, tag)
 
         try:
             # Handle each command case
             if cmd == 'status':
-                ## get status(es)
-                ## loop through remaining items of cmdStrList
-                if len(args) != 0:
-                    for dev in args:
-                        if dev == 'a':
-                            result_a1 = self.axis_a.get_move_status()
-                            result_a2 = self.axis_a.get_position()
-                            
-                            if 'BAD' not in result_a1 and 'BAD' not in result_a2:
-                                units_a = self.axis_a.units
-                                retData += f'\na={result_a1[1]}, {result_a2[1]}{units_a}'
-                            else:
-                                retData += f'\nBAD'
-                                
-                        elif dev == 'b':
-                            result_b1 = self.axis_b.get_move_status()
-                            result_b2 = self.axis_b.get_position()
-                            
-                            if 'BAD' not in result_b1 and 'BAD' not in result_b2:
-                                units_b = self.axis_b.units
-                                retData += f'\nb={result_b1[1]}, {result_b2[1]}{units_b}'
-                            else:
-                                retData += f'\nBAD'
-
-                        elif dev == 'c':
-                            result_c1 = self.axis_c.get_move_status()
-                            result_c2 = self.axis_c.get_position()
-                            
-                            if 'BAD' not in result_c1 and 'BAD' not in result_c2:
-                                units_c = self.axis_c.units
-                                retData += f'\nc={result_c1[1]}, {result_c2[1]}{units_c}'
-                            else:
-                                retData += f'\nBAD'
-
-                        elif dev == 'd':
-                            result_d1 = self.axis_d.get_move_status()
-                            result_d2 = self.axis_d.get_position()
-                            
-                            if 'BAD' not in result_d1 and 'BAD' not in result_d2:
-                                units_d = self.axis_d.units
-                                retData += f'\nd={result_d1[1]}, {result_d2[1]}{units_d}'
-                            else:
-                                retData += f'\nBAD'
-                        else:
-                            retData = 'BAD, invalid stage selection'
-                else:
-                    result_a1 = self.axis_a.get_move_status()
-                    result_a2 = self.axis_a.get_position()
-                    units_a = self.axis_a.units
-                    retData += f'\na={result_a1[1]}, {result_a2[1]}{units_a}'
-
-                    result_b1 = self.axis_b.get_move_status()
-                    result_b2 = self.axis_b.get_position()
-                    units_b = self.axis_b.units
-                    retData += f'\nb={result_b1[1]}, {result_b2[1]}{units_b}'
-
-                    result_c1 = self.axis_c.get_move_status()
-                    result_c2 = self.axis_c.get_position()
-                    units_c = self.axis_c.units
-                    retData += f'\nc={result_c1[1]}, {result_c2[1]}{units_c}'
-
-                    result_d1 = self.axis_d.get_move_status()
-                    result_d2 = self.axis_d.get_position()
-                    units_d = self.axis_d.units
-                    retData += f'\nd={result_d1[1]}, {result_d2[1]}{units_d}'
-            
+                ## get status(es), from the poller's snapshots unless 'fresh'
+                fresh, args = self.parse_flag(args, 'fresh')
+                axes = self.select_axes(args)
+                futures = [self.submit_snapshot(stage, fresh) for name, stage in axes]
+                return self.finish(futures, lambda results: self.format_status(axes, results))
+
             elif cmd == 'state':
                 ## get move state
-                state = 'IDLE'
-                result_a = self.axis_a.get_move_status()
-                result_b = self.axis_b.get_move_status()
-                result_c = self.axis_c.get_move_status()
-                result_d = self.axis_d.get_move_status()
-
-                if 'BUSY' in result_a or 'BUSY' in result_b or \
-                    'BUSY' in result_c or 'BUSY' in result_d:
-                    state = 'BUSY'
-
-                retData += f',{state}'
+                fresh, args = self.parse_flag(args, 'fresh')
+                axes = self.select_axes([])
+                futures = [self.submit_snapshot(stage, fresh) for name, stage in axes]
+                return self.finish(futures, self.format_state)
 
             elif cmd == 'stop':
-                if len(args) != 0:
-                    for dev in args:
-                        if dev[0:2] == 'a':
-                            result_a = self.axis_a.stop()
-
-                            if 'BAD' not in result_a:
-                                retData += f'\n{result_a}'
-                            else:
-                                retData += f'\nBAD'
-                                
-                        elif dev[0:2] == 'b':
-                            result_b = self.axis_b.stop()
-
-                            if 'BAD' not in result_b:
-                                retData += f'\n{result_b}'
-                            else:
-                                retData += f'\nBAD'
-
-                        elif dev[0:2] == 'c':
-                            result_c = self.axis_c.stop()
-
-                            if 'BAD' not in result_c:
-                                retData += f'\n{result_c}'
-                            else:
-                                retData += f'\nBAD'
-
-                        elif dev[0:2] == 'd':
-                            result_d = self.axis_d.stop()
-
-                            if 'BAD' not in result_d:
-                                retData += f'\n{result_d}'
-                            else:
-                                retData += f'\nBAD'
-                        else:
-                            retData = 'BAD, invalid stage selection'
-                else:
-                    retData = 'BAD, invalid move command'
-
-                retData = 'OK'
+                if len(args) == 0:
+                    return self.reply_now('BAD, invalid move command')
+                axes = self.select_axes(args)
+                futures = self.submit_stop(axes)
+                return self.finish(futures, lambda results: 'OK')
 
             elif cmd == 'home':
-                if len(args) != 0:
-                    for dev in args:
-                        if dev == 'a':
-                            result_a = self.axis_a.home()
-                            if 'BAD' not in result_a:
-                                retData = retData + '\n' + result_a
-                            else:
-                                retData = retData + '\nBAD'
-                                
-                        elif dev == 'b':
-                            result_b = self.axis_b.home()
-                            if 'BAD' not in result_b:
-                                retData = retData + '\n' + result_b
-                            else:
-                                retData = retData + '\nBAD'
-
-                        elif dev == 'c':
-                            result_c = self.axis_c.home()
-                            if 'BAD' not in result_c:
-                                retData = retData + '\n' + result_c
-                            else:
-                                retData = retData + '\nBAD'
-
-                        elif dev == 'd':
-                            result_d = self.axis_d.home()
-                            if 'BAD' not in result_d:
-                                retData = retData + '\n' + result_d
-                            else:
-                                retData = retData + '\nBAD'
-                        else:
-                            retData = 'BAD, invalid stage selection'
+                ## the axes home concurrently; with 'notify' the reply comes
+                ## straight away and a HOMED event follows for each axis
+                withNotify, args = self.parse_flag(args, 'notify')
+                axes = self.select_axes(args)
+                futures = self.submit_home(axes)
+                if withNotify:
+                    return self.finish([], lambda results: self.watch_homes(axes, futures, notify))
+                elif len(args) != 0:
+                    return self.finish(futures, self.format_results)
                 else:
-                    result_a = self.axis_a.home()
-                    result_b = self.axis_b.home()
-                    result_c = self.axis_c.home()
-                    result_d = self.axis_d.home()
+                    return self.finish(futures, lambda results: 'OK')
 
             elif cmd == 'goto' or cmd == 'offset':
-                if len(args) != 0:
-                    for dev in args:
-                        if dev[0:2] == 'a=':
-                            try:
-                                val = float(dev[2:])
-                                if cmd == 'goto':
-                                    result_a = self.axis_a.goto_real(val)
-                                elif cmd == 'offset':
-                                    result_a = self.axis_a.offset_real(val)
-
-                                if 'BAD' not in result_a:
-                                    retData += f'\n{result_a}'
-                                else:
-                                    retData += f'\nBAD'
-                            except ValueError as e:
-                                retData = f'BAD, command failure: expected args float or int = {e}'
-                                self.log.error(retData)
-                                return retData
-                                
-                        elif dev[0:2] == 'b=':
-                            try:
-                                val = float(dev[2:])
-                                if cmd == 'goto':
-                                    result_b = self.axis_b.goto_real(val)
-                                elif cmd == 'offset':
-                                    result_b = self.axis_b.offset_real(val)
-
-                                if 'BAD' not in result_b:
-                                    retData += f'\n{result_b}'
-                                else:
-                                    retData += f'\nBAD'
-                            except ValueError as e:
-                                retData = f'BAD, command failure: expected args float or int = {e}'
-                                self.log.error(retData)
-                                return retData
-
-                        elif dev[0:2] == 'c=':
-                            try:
-                                val = float(dev[2:])
-                                if cmd == 'goto':
-                                    result_c = self.axis_c.goto_real(val)
-                                elif cmd == 'offset':
-                                    result_c = self.axis_c.offset_real(val)
-                                    
-                                if 'BAD' not in result_c:
-                                    retData += f'\n{result_c}'
-                                else:
-                                    retData += f'\nBAD'
-                            except ValueError as e:
-                                retData = f'BAD, command failure: expected args float or int = {e}'
-                                self.log.error(retData)
-                                return retData
-
-                        elif dev[0:2] == 'd=':
-                            try:
-                                val = float(dev[2:])
-                                if cmd == 'goto':
-                                    result_d = self.axis_d.goto_real(val)
-                                elif cmd == 'offset':
-                                    result_d = self.axis_d.offset_real(val)
-
-                                if 'BAD' not in result_d:
-                                    retData += f'\n{result_d}'
-                                else:
-                                    retData = retData + '\nBAD'
-                            except ValueError as e:
-                                retData = f'BAD, command failure: expected args float or int = {e}'
-                                self.log.error(retData)
-                                return retData
-                        else:
-                            retData = 'BAD, invalid stage selection'
-                else:
-                    retData = 'BAD, invalid move command'
+                ## with 'notify', a DONE event follows when each axis stops.
+                ## with 'sync', the axes are timed to arrive together
+                withNotify, args = self.parse_flag(args, 'notify')
+                withSync, args = self.parse_flag(args, 'sync')
+                if len(args) == 0:
+                    return self.reply_now('BAD, invalid move command')
+                moves = self.parse_axis_values(args)
+                if withSync:
+                    pending = self.syncMover.submit_move(moves, cmd == 'offset')
+                    if withNotify:
+                        axes = [(name, stage) for name, stage, val in moves]
+                        return self.finish([pending], lambda results: self.watch_sync(axes, results[0], notify))
+                    return pending
+                futures = []
+                for name, stage, val in moves:
+                    if cmd == 'goto':
+                        futures.append(self.submit(stage, stage.goto_real_async, val))
+                    elif cmd == 'offset':
+                        futures.append(self.submit(stage, stage.offset_real_async, val))
+                if withNotify:
+                    axes = [(name, stage) for name, stage, val in moves]
+                    return self.finish(futures, lambda results: self.watch_axes(axes, notify))
+                return self.finish(futures, lambda results: 'OK')
+
+            elif cmd == 'wait':
+                ## DONE event for each axis once its earlier commands are
+                ## done and it is IDLE
+                axes = self.select_axes(args)
+                futures = [self.submit(stage, self.register_wait, stage) for name, stage in axes]
+                return self.finish(futures, lambda results: self.watch_done(axes, results, notify))
+
+            elif cmd == 'sequence':
+                ## server-side waypoint sequence, see sequencer.py. It is
+                ## started as the reply is sent, so the reply comes first
+                return self.finish([], lambda results: self.sequencer.command(args, notify))
+
+            elif cmd == 'stream':
+                ## trajectory streaming through the controller's command
+                ## buffer, see streamer.py
+                return self.finish([], lambda results: self.streamer.command(args, notify))
+
+            elif cmd == 'flyscan':
+                ## constant speed sweep with sync out pulses, see flyscan.py
+                return self.finish([], lambda results: self.flyscanner.command(args, notify))
+
+            elif cmd == 'capture':
+                ## speed and following error from the controller's
+                ## measurement buffer, see capture.py
+                return self.finish([self.capture.command(args)], lambda results: results[0])
+
+            elif cmd == 'history':
+                ## positions from the poller's history, no hardware access
+                return self.reply_now(self.format_history(args))
+
+            elif cmd == 'profile':
+                ## 'profile,list' or 'profile,<axis>,<name>[,diff]': writes a
+                ## stage profile from the bundle (see genProfiles.py). With
+                ## 'diff' only the settings that differ are written, and
+                ## listed after the OK
+                if args == ['list']:
+                    return self.reply_now('OK' + ''.join(f'\n{name}' for name in self.profiles.names()))
+                withDiff, args = self.parse_flag(args, 'diff')
+                if len(args) != 2:
+                    return self.reply_now('BAD, invalid profile command')
+                (name, stage), = self.select_axes(args[:1])
+                if args[1] not in self.profiles:
+                    return self.reply_now(f'BAD, unknown profile {args[1]}')
+                if withDiff:
+                    futures = [self.submit(stage, stage.update_profile_async, self.profiles, args[1])]
+                    return self.finish(futures, self.format_profile_changes)
+                futures = [self.submit(stage, stage.apply_profile_async, self.profiles, args[1])]
+                return self.finish(futures, lambda results: results[0])
+
+            elif cmd == 'policy':
+                ## slow client policy of this connection
+                if self.transmitter is None or writer is None or len(args) != 1 or args[0] not in POLICIES:
+                    return self.reply_now('BAD, invalid policy command')
+                self.transmitter.set_policy(writer, args[0])
+                return self.reply_now('OK')
+
+            elif cmd == 'xmitstats':
+                ## output queue counters of every connection
+                if self.transmitter is None:
+                    return self.reply_now('BAD, no transmitter')
+                return self.reply_now('OK' + ''.join(f'\n{line}' for line in self.transmitter.stats()))
 
-                retData = 'OK'
-                
             else:
                 retData = f'BAD,command failure: unknown command {cmd!r}'
                 self.log.error(retData)
-                return retData
+                return self.reply_now(retData)
+
+        except KeyError as e:
+            return self.reply_now('BAD, invalid stage selection')
 
-            return retData
-        
         except (TypeError, ValueError) as e:
             retData = f'BAD,command failure: expected args float or int = {e}'
             self.log.error(retData)
+            return self.reply_now(retData)
+
+    def submit_binary(self, request):
+        """
+        Queues the axis work for a binary protocol request (see
+        binaryProtocol.py), the same way submit_command() does for text.
+
+        Output:
+        - awaitable that resolves to the reply frame
+        """
+        opcode = request.opcode
+        tag = request.tag
+        rejected = binaryProtocol.pack_reply(opcode, tag, binaryProtocol.RESULT_BAD, 0)
+
+        try:
+            names = [AXIS_NAMES[i] for i in binaryProtocol.mask_axes(request.axisMask)]
+            if len(names) == 0 and opcode != binaryProtocol.OP_STATUS and opcode != binaryProtocol.OP_WAIT:
+                return self.reply_now(rejected)
+            axes = self.select_axes(names)
+            axisMask = binaryProtocol.axes_mask(AXIS_NAMES.index(name) for name, stage in axes)
+
+            if opcode == binaryProtocol.OP_STATUS:
+                fresh = bool(request.flags & binaryProtocol.FLAG_FRESH)
+                futures = [self.submit_snapshot(stage, fresh) for name, stage in axes]
+                formatter = lambda results: self.format_binary_status(opcode, tag, axisMask, results)
+
+            elif opcode == binaryProtocol.OP_WAIT:
+                futures = [self.submit_wait(stage) for name, stage in axes]
+                formatter = lambda results: self.format_binary_status(opcode, tag, axisMask, results)
+
+            elif opcode == binaryProtocol.OP_GOTO or opcode == binaryProtocol.OP_OFFSET:
+                futures = []
+                for (name, stage), val in zip(axes, request.values):
+                    if opcode == binaryProtocol.OP_GOTO:
+                        futures.append(self.submit(stage, stage.goto_real_async, val))
+                    else:
+                        futures.append(self.submit(stage, stage.offset_real_async, val))
+                formatter = lambda results: self.format_binary_results(opcode, tag, axisMask, results)
+
+            elif opcode == binaryProtocol.OP_STOP:
+                futures = self.submit_stop(axes)
+                formatter = lambda results: self.format_binary_results(opcode, tag, axisMask, results)
+
+            else:
+                self.log.error(f'BAD,command failure: unknown opcode {opcode}')
+                return self.reply_now(rejected)
+
+        except KeyError as e:
+            return self.reply_now(rejected)
+
+        return self.finish(futures, formatter, rejected)
+
+    def format_binary_status(self, opcode, tag, axisMask, results):
+        result = binaryProtocol.RESULT_OK
+        records = []
+        for response, stageStatus in results:
+            if response != 'OK':
+                result = binaryProtocol.RESULT_BAD
+                records.append((binaryProtocol.STATE_BAD, 0.0))
+            elif stageStatus.moveState == 'BUSY':
+                records.append((binaryProtocol.STATE_BUSY, stageStatus.position))
+            else:
+                records.append((binaryProtocol.STATE_IDLE, stageStatus.position))
+        return binaryProtocol.pack_reply(opcode, tag, result, axisMask, records)
+
+    def format_binary_results(self, opcode, tag, axisMask, results):
+        result = binaryProtocol.RESULT_OK
+        records = []
+        for response in results:
+            if 'BAD' in response:
+                result = binaryProtocol.RESULT_BAD
+                records.append(binaryProtocol.RESULT_BAD)
+            else:
+                records.append(binaryProtocol.RESULT_OK)
+        return binaryProtocol.pack_reply(opcode, tag, result, axisMask, records)
+
+    def select_axes(self, args):
+        """
+        Returns [(name, stage)] for the given axis names, or for every axis
+        if none are given. Raises KeyError for an unknown or missing axis.
+        """
+        if len(args) == 0:
+            args = AXIS_NAMES
+
+        axes = []
+        for dev in args:
+            stage = self.axes[dev]
+            if not stage:
+                raise KeyError(dev)
+            axes.append((dev, stage))
+        return axes
+
+    def parse_axis_values(self, args):
+        """
+        Returns [(name, stage, value)] for args of the form 'a=1.5'. Raises
+        KeyError for an unknown axis and ValueError for a bad value.
+        """
+        moves = []
+        for dev in args:
+            name, sep, val = dev.partition('=')
+            if sep == '':
+                raise KeyError(dev)
+            (name, stage), = self.select_axes([name])
+            moves.append((name, stage, float(val)))
+        return moves
+
+    def parse_flag(self, args, flag):
+        """
+        Removes an optional flag, ie. 'fresh', from a command's args.
+
+        Output:
+        - found     True if the flag was given
+        - args      The remaining args
+        """
+        found = flag in args
+        return found, [dev for dev in args if dev != flag]
+
+    def submit_snapshot(self, stage, fresh):
+        """
+        Returns an awaitable for the (response, StageStatus) of one axis. A
+        fresh read is queued on the axis lane so it follows earlier commands.
+        """
+        if fresh:
+            return self.submit(stage, self.poller.get_status, stage, True)
+        else:
+            return self.poller.get_status(stage)
+
+    async def register_wait(self, stage):
+        return self.poller.wait_idle(stage)
+
+    def submit_wait(self, stage):
+        """
+        Returns an awaitable for the (response, StageStatus) of one axis once
+        its earlier commands are done and it is IDLE.
+        """
+        return self.wait_registered(self.submit(stage, self.register_wait, stage))
+
+    async def wait_registered(self, registered):
+        idle = await registered
+        return 'OK', await idle
+
+    def watch_axes(self, axes, notify):
+        """
+        Starts waiting for the given axes to be IDLE. Returns the 'OK' reply.
+        """
+        idles = [self.poller.wait_idle(stage) for name, stage in axes]
+        return self.watch_done(axes, idles, notify)
+
+    def watch_sync(self, axes, retData, notify):
+        """
+        Starts waiting for the axes of a synchronized move to be IDLE, if it
+        started. Returns its reply.
+        """
+        if retData.startswith('OK'):
+            self.watch_axes(axes, notify)
+        return retData
+
+    def watch_done(self, axes, idles, notify):
+        """
+        Sends a DONE event through notify as each axis becomes IDLE. Returns
+        the 'OK' reply.
+        """
+        for (name, stage), idle in zip(axes, idles):
+            spawn(self.send_done(name, idle, notify))
+        return 'OK'
+
+    async def send_done(self, name, idle, notify):
+        try:
+            stageStatus = await idle
+        except ConnectionError as e:
+            notify(f'DONE,{name},BAD: {e}')
+            return
+        notify(f'DONE,{name},{stageStatus.position}')
+
+    def submit_stop(self, axes):
+        """
+        Stops the given axes on their device threads straight away, not
+        through their lanes, which a synchronized move or fly scan holds
+        until it is done. Anything driving the axes is aborted first, so it
+        sends them nothing more. Another stop is queued on each lane, for
+        moves queued before this stop that have not been sent yet.
+
+        Output:
+        - list of awaitables, one per axis, for the stop() response
+        """
+        stages = [stage for name, stage in axes]
+        self.syncMover.abort(stages)
+        self.flyscanner.abort(stages)
+        self.sequencer.abort(stages)
+        self.streamer.abort(stages)
+        for stage in stages:
+            spawn(self.queued_stop(self.submit(stage, stage.stop_async)))
+        return [stage.stop_async() for stage in stages]
+
+    async def queued_stop(self, future):
+        try:
+            await future
+        except ConnectionError:
+            pass  # offline, the stop sent straight away has failed too
+
+    def submit_home(self, axes):
+        """
+        Queues homing on the lanes of the given axes. Each axis homes on its
+        own controller, so they all home at once.
+
+        Output:
+        - list of futures, one per axis, for the home() response
+        """
+        return [self.submit(stage, self.home_axis, name, stage) for name, stage in axes]
+
+    async def home_axis(self, name, stage):
+        """
+        Lane job: homes one axis. The lane is held until homing is over, so
+        later commands to the axis wait for it, but the device is not read
+        here: the end of homing is taken from the poller's samples, and a
+        stop goes ahead of the lane (see submit_stop).
+        """
+        startTime = time.perf_counter()
+        response = await stage.start_home_async()
+        if response == 'OK':
+            try:
+                stageStatus = await self.poller.wait_idle(stage)
+            except ConnectionError as e:
+                response = f'BAD: {e}'
+            else:
+                response = await stage.finish_home_async(stageStatus)
+        self.log.info(f'{name}: home {response} in {time.perf_counter() - startTime:.2f}s')
+        return response
+
+    async def home_all(self):
+        """
+        Homes every connected axis, ie. at startup. Returns once they are all
+        done.
+        """
+        axes = [(name, stage) for name, stage in self.axes.items() if stage]
+        startTime = time.perf_counter()
+        results = await asyncio.gather(*self.submit_home(axes), return_exceptions=True)
+        failed = [name for (name, stage), result in zip(axes, results) if result != 'OK']
+        if failed:
+            self.log.error(f'homing failed on {"/".join(failed)}')
+        self.log.info(f'homed {len(axes) - len(failed)}/{len(axes)} axes in {time.perf_counter() - startTime:.2f}s')
+        return results
+
+    def watch_homes(self, axes, futures, notify):
+        """
+        Sends a HOMED event through notify as each axis finishes homing, then
+        'HOMED,ALL,OK' (or BAD) once they all have. Returns the 'OK' reply.
+        """
+        tasks = [spawn(self.send_homed(name, future, notify))
+                 for (name, stage), future in zip(axes, futures)]
+        spawn(self.send_homed_all(tasks, notify))
+        return 'OK'
+
+    async def send_homed(self, name, future, notify):
+        try:
+            response = await future
+        except Exception as e:
+            response = f'BAD: {e}'
+        notify(f'HOMED,{name},{response}')
+        return response == 'OK'
+
+    async def send_homed_all(self, tasks, notify):
+        homed = await asyncio.gather(*tasks)
+        notify(f'HOMED,ALL,{"OK" if all(homed) else "BAD"}')
+
+    def format_status(self, axes, results):
+        """
+        Returns the status reply with one line per axis, ie. 'a=IDLE, 12.3deg'
+        """
+        retData = 'OK'
+        for (name, stage), (response, stageStatus) in zip(axes, results):
+            if response == 'OK':
+                retData += f'\n{name}={stageStatus.moveState}, {stageStatus.position}{stage.units}'
+            elif not stage.online:
+                retData += f'\n{name}=OFFLINE'
+            else:
+                retData += '\nBAD'
+        return retData
+
+    def format_state(self, results):
+        state = 'IDLE'
+        for response, stageStatus in results:
+            if response == 'OK' and stageStatus.moveState == 'BUSY':
+                state = 'BUSY'
+        return f'OK,{state}'
+
+    def format_history(self, args):
+        """
+        Replies to 'history,<axis>,at,<t>,<t>,...' with the interpolated
+        position at each time (time.time() seconds), or to
+        'history,<axis>,window,<t0>,<t1>' with every sample between t0 and
+        t1. One 'time,position,stepPosition,encPosition,state' line each;
+        times outside the history give 'time,NONE'.
+        """
+        if len(args) < 3 or args[1] not in ('at', 'window'):
+            return 'BAD, invalid history command'
+        (name, stage), = self.select_axes([args[0]])
+        history = self.poller.histories[stage]
+        times = [float(t) for t in args[2:]]
+
+        if args[1] == 'at':
+            samples = history.at(times)
+        elif len(times) == 2:
+            samples = history.window(*times)
+        else:
+            return 'BAD, invalid history command'
+
+        retData = f'OK,{len(samples)}'
+        for sample in samples:
+            if sample['position'] != sample['position']:  # NaN, outside the history
+                retData += f'\n{sample["time"]:.6f},NONE'
+            else:
+                state = 'BUSY' if sample['busy'] else 'IDLE'
+                retData += (f'\n{sample["time"]:.6f},{sample["position"]},{sample["stepPosition"]},'
+                            f'{sample["encPosition"]},{state}')
+        return retData
+
+    def format_profile_changes(self, results):
+        response, changed = results[0]
+        if response != 'OK':
+            return response
+        return 'OK' + ''.join(f'\n{setting}' for setting in changed)
+
+    def format_results(self, results):
+        retData = 'OK'
+        for result in results:
+            if 'BAD' not in result:
+                retData += f'\n{result}'
+            else:
+                retData += '\nBAD'
+        return retData
+
+    async def finish(self, futures, formatter, failed=None):
+        """
+        Waits for the submitted axis jobs and formats their results. If a job
+        raises, the reply is failed, or a BAD message when failed is None.
+        """
+        try:
+            results = await asyncio.gather(*futures)
+        except Exception as e:
+            retData = f'BAD,command failure: {e}'
+            self.log.error(retData)
+            if failed is not None:
+                return failed
             return retData
+        return formatter(results)
+
+    def reply_now(self, retData):
+        return self.finish([], lambda results: retData)
 
     async def enqueue_xmit(self, msg):
         await self.qXmit.put(msg)
-
-    def enqueue_udp(self, msg):
-        self.qUDP.put(msg)
\ No newline at end of file
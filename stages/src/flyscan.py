@@ -0,0 +1,183 @@
+# flyscan.py
+#
+# Hardware-triggered fly scans. Instead of step, settle and poll, the axis
+# sweeps from start to stop at a constant speed while the controller's
+# sync output pulses at a fixed spacing of travel, to trigger a detector.
+#
+#   flyscan,<axis>,<start>,<stop>,<spacing>[,<speed>]
+#       start, stop and spacing in real units, speed in real units/s
+#       (default: the axis' current speed)
+#   flyscan,<axis>,status   OK,RUNNING or OK,IDLE
+#   flyscan,<axis>,abort    stops the sweep early, as does stop,<axis>
+#
+# The sync output and speed settings of the axis are restored afterwards,
+# whichever way the scan ends. Progress is sent to the client that started
+# the scan as events:
+# FLYSCAN,<axis>,START,<pulses>  FLYSCAN,<axis>,DONE,<pulses>,<p1>,<p2>,...
+# FLYSCAN,<axis>,ABORTED,<pulses>,<p1>,...  FLYSCAN,<axis>,FAILED,<reason>
+# where <p1>,... are the positions (real units) the pulses were sent at.
+
+import logging
+import asyncio
+import math
+import time
+
+from backgroundTasks import spawn
+
+class FlyScanner:
+    def __init__(self, axes, poller, submit, pollInterval=0.01):
+        """
+        Input:
+        - axes          dict of axis name -> Stage
+        - poller        StatusPoller, whose snapshots are updated as we wait
+        - submit        CMDLoop.submit, to run scans on the axis lanes
+        - pollInterval  seconds between status reads of the moving axis
+        """
+        self.logger = logging.getLogger('stages')
+        self.axes = axes
+        self.poller = poller
+        self.submit = submit
+        self.pollInterval = pollInterval
+        self.tasks = {}
+        self.aborted = set()
+
+    def command(self, args, notify):
+        """
+        Handles the arguments of a 'flyscan' command.
+
+        Output:
+        - The reply string
+        """
+        if len(args) < 2:
+            return 'BAD, invalid flyscan command'
+
+        name = args[0]
+        stage = self.axes.get(name)
+        if not stage:
+            return 'BAD, invalid stage selection'
+        task = self.tasks.get(name)
+        running = task is not None and not task.done()
+
+        if args[1:] == ['status']:
+            return 'OK,RUNNING' if running else 'OK,IDLE'
+
+        elif args[1:] == ['abort']:
+            if not running:
+                return 'BAD, no flyscan running'
+            self.abort([stage])
+            spawn(stage.stop_async())
+            return 'OK'
+
+        try:
+            if len(args) not in (4, 5):
+                raise ValueError('expected start, stop, spacing[, speed]')
+            start, stop, spacing = [float(val) for val in args[1:4]]
+            speed = float(args[4]) if len(args) == 5 else None
+        except ValueError as e:
+            return f'BAD, invalid flyscan: {e}'
+
+        low, high = stage.softStops
+        if not (low <= start <= high and low <= stop <= high):
+            return f'BAD, flyscan outside soft stops {stage.softStops}'
+        if spacing <= 0 or (speed is not None and speed <= 0):
+            return 'BAD, flyscan spacing and speed must be positive'
+        period = round(spacing / abs(stage.conversionFactor))
+        if period < 1:
+            return 'BAD, flyscan spacing is less than one step'
+        if running:
+            return 'BAD, flyscan already running'
+
+        self.aborted.discard(name)
+        self.tasks[name] = self.submit(stage, self.scan, name, stage, start, stop, period, speed, notify)
+        return 'OK'
+
+    def abort(self, stages):
+        """
+        Marks the fly scans of the given stages as aborted, so they send no
+        more moves and end as soon as their axes are IDLE. Stopping the axes
+        is left to the caller: the scans hold the axis lanes, so the stop
+        has to go ahead of them.
+        """
+        for name, task in self.tasks.items():
+            if not task.done() and self.axes[name] in stages:
+                self.aborted.add(name)
+
+    async def scan(self, name, stage, start, stop, period, speed, notify):
+        """
+        Runs one fly scan. It is a single job on the axis lane, so no other
+        command to the axis runs until the settings are restored.
+        """
+        # real units per pulse, as the controller will actually space them
+        spacing = period * abs(stage.conversionFactor)
+        try:
+            if name not in self.aborted:
+                await self.move(stage, start)
+            if name in self.aborted:
+                notify(f'FLYSCAN,{name},ABORTED,0')
+                return
+
+            response, sost = await stage.get_sync_out_settings_async()
+            self.check(response)
+            response, (steps, usteps) = await stage.get_speed_async()
+            self.check(response)
+        except Exception as e:
+            notify(f'FLYSCAN,{name},FAILED,{e}')
+            return
+
+        try:
+            if speed is not None:
+                self.check(await stage.set_speed_async(speed / abs(stage.conversionFactor)))
+            self.check(await stage.enable_sync_out_async(period))
+
+            response, stageStatus = await self.poller.sample(stage)
+            self.check(response)
+            origin = stageStatus.position
+            if name in self.aborted:
+                notify(f'FLYSCAN,{name},ABORTED,0')
+                return
+
+            notify(f'FLYSCAN,{name},START,{int(abs(stop - origin) / spacing)}')
+            stageStatus = await self.move(stage, stop)
+            pulses = self.pulse_positions(origin, stageStatus.position, spacing)
+            if name in self.aborted:
+                notify(f'FLYSCAN,{name},ABORTED,{len(pulses)}' + ''.join(f',{p}' for p in pulses))
+            else:
+                notify(f'FLYSCAN,{name},DONE,{len(pulses)}' + ''.join(f',{p}' for p in pulses))
+
+        except Exception as e:
+            self.logger.error(f'{name}: flyscan failed: {e}')
+            notify(f'FLYSCAN,{name},FAILED,{e}')
+
+        finally:
+            response = await stage.set_sync_out_settings_async(sost)
+            if response != 'OK':
+                self.logger.error(f'{name}: could not restore sync out settings: {response}')
+            response = await stage.set_speed_async(steps + usteps / 256)
+            if response != 'OK':
+                self.logger.error(f'{name}: could not restore speed: {response}')
+
+    def check(self, response):
+        if response != 'OK':
+            raise RuntimeError(response)
+
+    def pulse_positions(self, origin, end, spacing):
+        """
+        Returns the positions of the pulses sent between origin and end
+        """
+        direction = math.copysign(1, end - origin)
+        count = int(abs(end - origin) / spacing + 1e-9)
+        return [origin + direction * spacing * k for k in range(1, count + 1)]
+
+    async def move(self, stage, position):
+        """
+        Moves the Stage to position and returns its StageStatus once it is
+        IDLE again.
+        """
+        self.check(await stage.goto_real_async(position))
+        since = time.time()
+        while True:
+            await asyncio.sleep(self.pollInterval)
+            response, stageStatus = await self.poller.sample(stage)
+            self.check(response)
+            if stageStatus.moveState == 'IDLE' and stageStatus.time > since:
+                return stageStatus
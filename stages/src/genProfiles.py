@@ -0,0 +1,100 @@
+#!/usr/local/bin/python3.8
+# genProfiles.py
+#
+# Builds a profile bundle from the libximc python profiles: every
+# set_profile_*(lib, id) script is run once against a recording lib, and
+# the settings structs it writes are stored as raw bytes, one record per
+# profile, keyed by the stage part number (the script name). An index
+# (JSON) gives the order of the set_* calls, the struct sizes and the
+# offset of each profile's record, so profileBundle.py can list and apply
+# profiles without compiling any Python. Run this again when the profiles
+# or libximc are updated:
+#
+#   ./genProfiles.py [path/to/python-profiles/STANDA [output dir]]
+#
+# It writes <output dir>/STANDA.bin and STANDA.json.
+
+import os
+import re
+import sys
+import json
+import zlib
+from ctypes import *
+
+from ximcPath import XIMC_DIR
+import pyximc
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILES = os.path.join(XIMC_DIR, 'python-profiles', 'STANDA')
+OUTPUT = os.path.join(SRC_DIR, 'profiles')
+
+BUNDLE_VERSION = 1
+
+class RecordingLib:
+    """
+    Stands in for libximc while a profile script runs, keeping the
+    settings it writes: [(function name, struct)]
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(id, ref):
+            self.calls.append((name, ref._obj))
+            return pyximc.Result.Ok
+        return record
+
+def read_profile(path):
+    """
+    Runs one profile script.
+
+    Output:
+    - [(function name, struct)] in the order the script writes them
+    """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    funcName = re.search(r'^def (set_profile_\w+)\(', source, re.MULTILINE).group(1)
+
+    namespace = dict(vars(pyximc))
+    exec(compile(source, path, 'exec'), namespace)
+    recorder = RecordingLib()
+    namespace[funcName](recorder, 1)
+    return recorder.calls
+
+def generate(profilesDir=PROFILES, outputDir=OUTPUT):
+    bundleName = os.path.basename(os.path.normpath(profilesDir))
+    os.makedirs(outputDir, exist_ok=True)
+
+    layout = None
+    profiles = {}
+    offset = 0
+    with open(os.path.join(outputDir, f'{bundleName}.bin'), 'wb') as bundle:
+        for fileName in sorted(os.listdir(profilesDir)):
+            if not fileName.endswith('.py'):
+                continue
+            calls = read_profile(os.path.join(profilesDir, fileName))
+
+            callLayout = [[name, type(struct).__name__, sizeof(struct)] for name, struct in calls]
+            if layout is None:
+                layout = callLayout
+            elif callLayout != layout:
+                raise ValueError(f'{fileName}: writes different settings than the other profiles')
+
+            # mostly zeros, so each record is compressed on its own
+            record = zlib.compress(b''.join(bytes(struct) for name, struct in calls), 9)
+            bundle.write(record)
+            profiles[fileName[:-3]] = [offset, len(record)]
+            offset += len(record)
+
+    # one call or profile per line, so the index diffs well
+    with open(os.path.join(outputDir, f'{bundleName}.json'), 'w') as f:
+        f.write(f'{{"version": {BUNDLE_VERSION},\n "layout": [\n  ')
+        f.write(',\n  '.join(json.dumps(call) for call in layout))
+        f.write('],\n "profiles": {\n  ')
+        f.write(',\n  '.join(f'{json.dumps(name)}: {json.dumps(entry)}' for name, entry in profiles.items()))
+        f.write('}}\n')
+
+    print(f'{len(profiles)} profiles ({offset} bytes) written to {outputDir}/{bundleName}.bin')
+
+if __name__ == "__main__":
+    generate(*sys.argv[1:3])
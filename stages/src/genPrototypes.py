@@ -0,0 +1,137 @@
+#!/usr/local/bin/python3.8
+# genPrototypes.py
+#
+# Generates ximcPrototypes.py: ctypes argtypes/restype declarations for
+# every function in ximc.h. pyximc.py only declares the restype of
+# enumerate_devices and get_device_name, so every other call goes through
+# ctypes' generic argument conversion and returns a plain int. Run this
+# again when libximc is updated:
+#
+#   ./genPrototypes.py [path/to/ximc.h [path/to/pyximc.py [output.py]]]
+
+import os
+import re
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+XIMC_DIR = os.path.join(SRC_DIR, '..', 'ximc-2.13.3', 'ximc')
+XIMC_H = os.path.join(XIMC_DIR, 'ximc.h')
+PYXIMC = os.path.join(XIMC_DIR, 'crossplatform', 'wrappers', 'python', 'pyximc.py')
+OUTPUT = os.path.join(SRC_DIR, 'ximcPrototypes.py')
+
+# C type -> ctypes expression. Struct pointers are added from pyximc.py
+C_TYPES = {
+    'void': 'None',
+    'device_t': 'c_int',
+    'result_t': 'c_int',
+    'int': 'c_int',
+    'unsigned int': 'c_uint',
+    'uint32_t': 'c_uint32',
+    'float': 'c_float',
+    'char*': 'c_char_p',
+    'pchar': 'c_char_p',
+    'void*': 'c_void_p',
+    'wchar_t*': 'c_wchar_p',
+    'device_t*': 'POINTER(c_int)',
+    'unsigned int*': 'POINTER(c_uint)',
+    'uint32_t*': 'POINTER(c_uint32)',
+    'uint8_t*': 'POINTER(c_uint8)',
+    # pyximc passes the enumeration around as a pointer
+    'device_enumeration_t': 'POINTER(device_enumeration_t)',
+}
+
+PROTOTYPE = re.compile(r'^\s*([\w ]+?\*?)\s*XIMC_API\s+(\w+)\s*\(([^)]*)\)\s*;', re.MULTILINE)
+
+def c_type(decl, structs):
+    """
+    Returns the ctypes expression for a C parameter or return type, or
+    None if it has no ctypes equivalent here (ie. callbacks).
+    """
+    decl = decl.replace('const ', '').strip()
+    decl = re.sub(r'\s*\*', '*', decl)
+    if decl in C_TYPES:
+        return C_TYPES[decl]
+    if decl.endswith('*') and decl[:-1] in structs:
+        return f'POINTER({decl[:-1]})'
+    return None
+
+def parse_prototypes(header, structs):
+    """
+    Returns [(name, restype, argtypes or None)] for every function in the
+    header. argtypes is None if a parameter type is not supported.
+    """
+    prototypes = []
+    for match in PROTOTYPE.finditer(header):
+        ret, name, params = match.groups()
+        restype = c_type(ret, structs)
+
+        argtypes = []
+        for param in params.split(','):
+            param = param.strip()
+            if param in ('', 'void'):
+                continue
+            # drop the parameter name
+            paramType = re.sub(r'\s*\b\w+$', '', param)
+            argtypes.append(c_type(paramType, structs))
+        if None in argtypes:
+            argtypes = None
+
+        prototypes.append((name, restype, argtypes))
+    return prototypes
+
+def generate(headerPath=XIMC_H, pyximcPath=PYXIMC, outputPath=OUTPUT):
+    with open(headerPath, encoding='utf-8') as f:
+        header = f.read()
+    with open(pyximcPath, encoding='utf-8') as f:
+        structs = set(re.findall(r'^class (\w+_t)\(', f.read(), re.MULTILINE))
+
+    prototypes = parse_prototypes(header, structs)
+    lines = [
+        '# ximcPrototypes.py',
+        '#',
+        '# GENERATED by genPrototypes.py from ximc.h, do not edit.',
+        '#',
+        '# declare(lib) sets argtypes/restype on every libximc function, so',
+        '# ctypes converts arguments with the declared types instead of',
+        '# guessing, and returns them at full width. This is for correct',
+        '# types, not speed: declared calls are no faster (see benchXimc.py).',
+        '',
+        'from ctypes import *',
+        'from pyximc import *',
+        '',
+        '# name: (restype, argtypes), argtypes None where not declared',
+        'PROTOTYPES = {',
+    ]
+    for name, restype, argtypes in prototypes:
+        if argtypes is None:
+            lines.append(f'    {name!r}: ({restype}, None),')
+        else:
+            lines.append(f'    {name!r}: ({restype}, [{", ".join(argtypes)}]),')
+    lines += [
+        '}',
+        '',
+        'def declare(lib):',
+        '    """',
+        '    Declares the prototypes on a loaded libximc, in place. Functions this',
+        '    build of the library does not have are skipped.',
+        '    """',
+        '    for name, (restype, argtypes) in PROTOTYPES.items():',
+        '        try:',
+        '            func = getattr(lib, name)',
+        '        except AttributeError:',
+        '            continue',
+        '        func.restype = restype',
+        '        if argtypes is not None:',
+        '            func.argtypes = argtypes',
+        '',
+    ]
+    with open(outputPath, 'w') as f:
+        f.write('\n'.join(lines))
+
+    skipped = [name for name, restype, argtypes in prototypes if argtypes is None]
+    print(f'{len(prototypes)} prototypes written to {outputPath}')
+    if skipped:
+        print(f'argtypes not declared for: {", ".join(skipped)}')
+
+if __name__ == "__main__":
+    generate(*sys.argv[1:4])
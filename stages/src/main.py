@@ -14,12 +14,17 @@ import asyncio
 import argparse
 import shlex
 import netifaces
+import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from TCPip import TCPServer
 from cmdHandler import CMDLoop
-from transmitter import Transmitter
+from transmitter import Transmitter, POLICIES
 from UDPcast import UDPcast
+from statusPoller import StatusPoller
 from stageClass import Stage
+from supervisor import Supervisor
 
 CORRECTOR_ROTARY_SOFT_STOPS = (-180, 0) #deg
 CORRECTOR_ROTARY_HOME_OFFSET = 900 #steps
@@ -41,83 +46,207 @@ DMD_ROTARY_HOME_OFFSET = -1300 #steps
 DMD_ROTARY_CONVERSION_FACTOR = 0.0005
 DMD_ROTARY_UNITS = "deg"
 
+# serial (as found in the device URI), name and settings of each axis, a-d
+STAGES = [
+    ('4A291', "Corrector Rotary Stage", CORRECTOR_ROTARY_SOFT_STOPS, CORRECTOR_ROTARY_HOME_OFFSET,
+        CORRECTOR_ROTARY_CONVERSION_FACTOR, CORRECTOR_ROTARY_UNITS),
+    ('4A321', "AOI Rotary Stage", AOI_ROTARY_SOFT_STOPS, AOI_ROTARY_HOME_OFFSET,
+        AOI_ROTARY_CONVERSION_FACTOR, AOI_ROTARY_UNITS),
+    ('4A221', "DMD Linear Stage", DMD_LINEAR_SOFT_STOPS, DMD_LINEAR_HOME_OFFSET,
+        DMD_LINEAR_CONVERSION_FACTOR, DMD_LINEAR_UNITS),
+    ('4A0C1', "DMD Rotary Stage", DMD_ROTARY_SOFT_STOPS, DMD_ROTARY_HOME_OFFSET,
+        DMD_ROTARY_CONVERSION_FACTOR, DMD_ROTARY_UNITS),
+]
+
+# serial -> device URI of the stages found by the last USB probe
+DEVICE_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deviceMap.json')
+
 def custom_except_hook(loop, context):
     if repr(context['exception']) == 'SystemExit()':
         log.info('Exiting Program...')
 
-def open_devices():
-    devList, devCount = scan_for_devices()
+def load_device_map(mapPath):
+    """
+    Returns the cached {serial: device URI} map, or {} if there is none
+    """
+    try:
+        with open(mapPath) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log.info(f'no device map loaded from {mapPath}: {e}')
+        return {}
+
+def save_device_map(mapPath, deviceMap):
+    """
+    Writes the {serial: device URI} map, through a temporary file so a
+    crash never leaves half a map behind
+    """
+    try:
+        tmpPath = mapPath + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(deviceMap, f, indent=2)
+        os.replace(tmpPath, mapPath)
+    except OSError as e:
+        log.error(f'could not save device map {mapPath}: {e}')
+
+def open_stage(index, uri):
+    """
+    Opens the Stage for axis index (0=a .. 3=d) on a device URI.
+
+    Returns the Stage, or None if the device could not be opened
+    """
+    serial, name, softStops, homeOffset, conversionFactor, units = STAGES[index]
+    stage = Stage(lib, uri.encode(), name, softStops, homeOffset, conversionFactor, units)
+    if stage.stageDev > 0:
+        return stage
+    stage.close()
+    return None
+
+def has_serial(index, stage):
+    """
+    Returns True if the controller of an open Stage has the serial of axis
+    index (0=a .. 3=d). A cached URI can lead to another controller once
+    they are moved between USB ports.
+    """
+    serial = STAGES[index][0]
+    response, stageSerial = stage.get_serial_number()
+    if response == 'OK' and stageSerial == int(serial, 16):
+        return True
+    log.warning(f'{stage.name}: {stage.deviceID.decode()} is not serial {serial} ({response}, serial {stageSerial:X})')
+    return False
+
+def open_stages(uris):
+    """
+    Opens several Stages at once, one thread per device.
+
+    Input:
+    - uris      {axis index: device URI}
+
+    Output:
+    - {axis index: Stage or None}
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(uris))) as pool:
+        futures = {index: pool.submit(open_stage, index, uri) for index, uri in uris.items()}
+        return {index: future.result() for index, future in futures.items()}
+
+def open_devices(mapPath):
+    """
+    Opens every axis, trying the device URIs cached in mapPath first. The
+    slow USB probe only runs when a cached URI is missing, fails to open or
+    leads to a controller with another serial; the map is then updated
+    from the probe.
+    """
     openDevs = ['','','','']
+    phaseTime = time.perf_counter()
+
+    def phase(name):
+        nonlocal phaseTime
+        now = time.perf_counter()
+        log.info(f'startup: {name} took {1000*(now - phaseTime):.1f}ms')
+        phaseTime = now
+
+    deviceMap = load_device_map(mapPath)
+    phase('loading the device map')
+
+    cached = {i: deviceMap[stage[0]] for i, stage in enumerate(STAGES) if stage[0] in deviceMap}
+    for i, stage in open_stages(cached).items():
+        if stage is None:
+            log.warning(f'{STAGES[i][1]}: cached device {cached[i]} failed to open')
+        elif has_serial(i, stage):
+            openDevs[i] = stage
+        else:
+            # not kept for the Supervisor to reopen either
+            stage.close_device()
+            stage.close()
+            del deviceMap[STAGES[i][0]]
+    phase(f'opening {len(cached)} cached devices')
+
+    missing = [i for i in range(len(STAGES)) if not openDevs[i]]
+    if len(missing) > 0:
+        devList, devCount = scan_for_devices()
+        log.info("Number of devices = "+str(devCount))
+        for uri in devList:
+            log.info(repr(uri))
+        phase('probing for devices')
+
+        found = {}
+        for i in missing:
+            serial = STAGES[i][0]
+            for uri in devList:
+                if serial in repr(uri):
+                    found[i] = uri.decode()
+                    break
+
+        for i, stage in open_stages(found).items():
+            if stage is not None:
+                openDevs[i] = stage
+                deviceMap[STAGES[i][0]] = found[i]
+        phase(f'opening {len(found)} probed devices')
+
+        save_device_map(mapPath, deviceMap)
+
+    allDevCheck = True
+    for i, (serial, name, softStops, homeOffset, conversionFactor, units) in enumerate(STAGES):
+        if not openDevs[i]:
+            allDevCheck = False
+            log.error(f"BAD = {name} connection failed")
+            openDevs[i] = offline_stage(i, deviceMap.get(serial))
 
-    log.info("Number of devices = "+str(devCount))
-    if devCount == 0:
-        allDevCheck = False
+    return allDevCheck, openDevs
+
+def offline_stage(index, uri):
+    """
+    Returns the Stage for axis index (0=a .. 3=d) without opening it, for
+    the Supervisor to reopen once the controller is back.
+    """
+    serial, name, softStops, homeOffset, conversionFactor, units = STAGES[index]
+    stage = Stage(lib, None, name, softStops, homeOffset, conversionFactor, units)
+    if uri is not None:
+        stage.deviceID = uri.encode()
+    return stage
+
+def locate_device(mapPath, stage):
+    """
+    Probes USB for the controller of a Stage and records where it was found
+    in the device map.
+
+    Returns the device URI, or None if it was not found
+    """
+    for serial, name, softStops, homeOffset, conversionFactor, units in STAGES:
+        if name == stage.name:
+            break
     else:
-        allDevCheck = True
-        try:
-            log.info("List of devices = ")
-
-            for i in devList:
-                log.info(repr(i))
-
-                # Corrector Rotary Stage
-                if '4A291' in repr(i):
-                    axis_a = Stage(lib, i, "Corrector Rotary Stage",
-                        CORRECTOR_ROTARY_SOFT_STOPS,
-                        CORRECTOR_ROTARY_HOME_OFFSET,
-                        CORRECTOR_ROTARY_CONVERSION_FACTOR,
-                        CORRECTOR_ROTARY_UNITS)
-
-                    if axis_a.stageDev > 0:
-                        openDevs[0] = axis_a
-                    else:
-                        allDevCheck = False
-                        log.error("BAD = Corrector Rotary Stage connection failed")
-
-                # AOI Rotary Stage
-                elif '4A321' in repr(i):
-                    axis_b = Stage(lib, i, "AOI Rotary Stage",
-                        AOI_ROTARY_SOFT_STOPS,
-                        AOI_ROTARY_HOME_OFFSET,
-                        AOI_ROTARY_CONVERSION_FACTOR,
-                        AOI_ROTARY_UNITS)
-
-                    if axis_b.stageDev > 0:
-                        openDevs[1] = axis_b
-                    else:
-                        allDevCheck = False
-                        log.error("BAD = AOI Rotary Stage connection failed")
-
-                # DMD Linear Stage
-                elif '4A221' in repr(i):
-                    axis_c = Stage(lib, i, "DMD Linear Stage",
-                        DMD_LINEAR_SOFT_STOPS,
-                        DMD_LINEAR_HOME_OFFSET,
-                        DMD_LINEAR_CONVERSION_FACTOR,
-                        DMD_LINEAR_UNITS)
-
-                    if axis_c.stageDev > 0:
-                        openDevs[2] = axis_c
-                    else:
-                        allDevCheck = False
-                        log.error("BAD = DMD Linear Stage connection failed")
-
-                # DMD Rotary Stage
-                elif '4A0C1' in repr(i):
-                    axis_d = Stage(lib, i, "DMD Rotary Stage", \
-                        DMD_ROTARY_SOFT_STOPS,
-                        DMD_ROTARY_HOME_OFFSET,
-                        DMD_ROTARY_CONVERSION_FACTOR,
-                        DMD_ROTARY_UNITS)
-
-                    if axis_d.stageDev > 0:
-                        openDevs[3] = axis_d
-                    else:
-                        allDevCheck = False
-                        log.error("BAD = DMD Rotary Stage connection failed")
-
-        except IndexError:
-            log.error("No devices to list...")
+        return None
+
+    devList, devCount = scan_for_devices()
+    for uri in devList:
+        if serial in repr(uri):
+            deviceMap = load_device_map(mapPath)
+            deviceMap[serial] = uri.decode()
+            save_device_map(mapPath, deviceMap)
+            return uri
+    return None
+
+def open_virtual_devices(virtualDir):
+    """
+    Opens a libximc virtual controller (xi-emu) for every axis instead of
+    the USB devices. The emulated controller state of axis a is kept in
+    virtualDir/axis_a.bin, etc.
+    """
+    openDevs = ['','','','']
+    allDevCheck = True
+    os.makedirs(virtualDir, exist_ok=True)
+
+    for i, (serial, name, softStops, homeOffset, conversionFactor, units) in enumerate(STAGES):
+        path = os.path.abspath(os.path.join(virtualDir, f'axis_{"abcd"[i]}.bin'))
+        uri = f'xi-emu://{path}'.encode()
+        log.info(f'virtual device: {uri!r}')
+
+        stage = Stage(lib, uri, name, softStops, homeOffset, conversionFactor, units)
+        openDevs[i] = stage
+        if stage.stageDev <= 0:
+            allDevCheck = False
+            log.error(f"BAD = {name} connection failed")
 
     return allDevCheck, openDevs
 
@@ -142,23 +271,39 @@ def scan_for_devices():
         if result == Result.Ok:
             devices_list.append(enum_name)
 
+    lib.free_enumerate_devices(devenum)
     return devices_list, dev_count
 
 async def runStages(opts, openDevs):
     log.setLevel(opts.logLevel)
     log.info('starting logging')
     
-    ip_address = netifaces.ifaddresses('en0')[netifaces.AF_INET][0]['addr']
-    udp_address = netifaces.ifaddresses('en0')[netifaces.AF_INET][0]['broadcast']
+    ifAddress = netifaces.ifaddresses(opts.interface)[netifaces.AF_INET][0]
+    ip_address = ifAddress['addr']
+    udp_address = ifAddress.get('broadcast', ip_address)
     log.info(f'IP:  {ip_address}')
     log.info(f'UDP: {udp_address}')
 
-    tcpServer = TCPServer(ip_address, 1024)
-    cmdHandler = CMDLoop(tcpServer.qCmd, tcpServer.qXmit, openDevs)
-    transmitter = Transmitter(tcpServer.qXmit)
-    udpServer = UDPcast(udp_address, 8888, cmdHandler.qUDP)
+    tcpServer = TCPServer(ip_address, opts.port)
+    poller = StatusPoller(openDevs, opts.pollRate, opts.historySize)
+    transmitter = Transmitter(tcpServer.qXmit, opts.xmitQueue, opts.slowPolicy)
+    cmdHandler = CMDLoop(tcpServer.qCmd, tcpServer.qXmit, openDevs, poller, transmitter)
+    udpServer = UDPcast(udp_address, opts.udpPort, cmdHandler.axes, poller, opts.udpRate, opts.udpOnChange)
+    if opts.virtual is None:
+        locate = functools.partial(locate_device, opts.deviceMap)
+    else:
+        locate = None
+    supervisor = Supervisor(cmdHandler.axes, poller, opts.healthInterval, locate=locate)
+
+    tasks = [tcpServer.start(), poller.start(), cmdHandler.start(), transmitter.start(),
+             udpServer.start(), supervisor.start()]
+    if opts.homeOnStartup:
+        # queued on the axis lanes ahead of any client command, so the axes
+        # home while the servers come up and later moves wait for homing
+        log.info('homing all axes')
+        tasks.append(cmdHandler.home_all())
 
-    await asyncio.gather(tcpServer.start(), cmdHandler.start(), transmitter.start(), udpServer.start())
+    await asyncio.gather(*tasks)
 
 def main(argv=None):
     if argv is None:
@@ -169,12 +314,47 @@ def main(argv=None):
     parser = argparse.ArgumentParser(sys.argv[0])
     parser.add_argument('--logLevel', type=int, default=logging.INFO,
                         help='logging threshold. 10=debug, 20=info, 30=warn')
+    parser.add_argument('--pollRate', type=float, default=10.0,
+                        help='rate (Hz) at which the status of each axis is sampled')
+    parser.add_argument('--historySize', type=int, default=36000,
+                        help='status samples kept in the position history of each axis')
+    parser.add_argument('--udpPort', type=int, default=8888,
+                        help='UDP port of the telemetry broadcast')
+    parser.add_argument('--udpRate', type=float, default=10.0,
+                        help='rate (Hz) of the UDP telemetry broadcast')
+    parser.add_argument('--udpOnChange', action='store_true',
+                        help='only broadcast telemetry when an axis changes (plus a 1s heartbeat)')
+    parser.add_argument('--xmitQueue', type=int, default=100,
+                        help='maximum number of replies queued for one client')
+    parser.add_argument('--slowPolicy', type=str, default='drop', choices=POLICIES,
+                        help='what to do when a client falls behind: drop, coalesce or disconnect')
+    parser.add_argument('--homeOnStartup', action='store_true',
+                        help='home all axes at startup, while the servers start')
+    parser.add_argument('--healthInterval', type=float, default=1.0,
+                        help='seconds between health checks of the controllers')
+    parser.add_argument('--requireAll', action='store_true',
+                        help='refuse to start unless every stage is connected')
+    parser.add_argument('--interface', type=str, default='en0',
+                        help='network interface to serve on')
+    parser.add_argument('--port', type=int, default=1024,
+                        help='TCP port to serve on')
+    parser.add_argument('--deviceMap', type=str, default=DEVICE_MAP,
+                        help='file caching the device URI of each stage serial')
+    parser.add_argument('--virtual', type=str, default=None, metavar='DIR',
+                        help='use libximc virtual controllers kept in DIR instead of USB devices')
     opts = parser.parse_args(argv)
     log.setLevel(opts.logLevel)
 
-    allDevCheck, openDevs = open_devices()
+    startTime = time.perf_counter()
+    if opts.virtual is not None:
+        allDevCheck, openDevs = open_virtual_devices(opts.virtual)
+    else:
+        allDevCheck, openDevs = open_devices(opts.deviceMap)
+    log.info(f'startup: devices opened in {1000*(time.perf_counter() - startTime):.1f}ms')
     
-    if allDevCheck:
+    if allDevCheck or not opts.requireAll:
+        if not allDevCheck:
+            log.warning('Not all devices are available, starting without them. They are reopened once they are back.')
         loop = asyncio.get_event_loop()
         loop.set_exception_handler(custom_except_hook)
         try:
@@ -0,0 +1,60 @@
+# positionHistory.py
+#
+# Position history of one axis: a ring buffer of timestamped samples, fed
+# from the status samples the server takes anyway (see StatusPoller), so
+# "where was the axis at time T" is answered without touching the
+# hardware.
+
+import numpy as np
+
+from ringBuffer import RingBuffer
+
+HISTORY_DTYPE = np.dtype([('time', 'f8'), ('stepPosition', 'f8'), ('encPosition', 'i8'),
+                          ('position', 'f8'), ('busy', '?')])
+
+class PositionHistory:
+    def __init__(self, size):
+        self.buffer = RingBuffer(size, HISTORY_DTYPE)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, stageStatus):
+        self.buffer.append((stageStatus.time, stageStatus.stepPosition, stageStatus.encPosition,
+                            stageStatus.position, stageStatus.moveState == 'BUSY'))
+
+    def at(self, times):
+        """
+        Returns the interpolated history at each of the given times, as a
+        structured array. busy is taken from the sample before each time.
+        Times outside the history get NaN positions.
+        """
+        samples = self.buffer.array()
+        times = np.asarray(times, dtype='f8')
+        result = np.zeros(len(times), dtype=HISTORY_DTYPE)
+        result['time'] = times
+        if len(samples) == 0:
+            result['stepPosition'] = np.nan
+            result['position'] = np.nan
+            return result
+
+        result['stepPosition'] = np.interp(times, samples['time'], samples['stepPosition'])
+        result['encPosition'] = np.rint(np.interp(times, samples['time'], samples['encPosition']))
+        result['position'] = np.interp(times, samples['time'], samples['position'])
+        before = np.clip(np.searchsorted(samples['time'], times, side='right') - 1, 0, len(samples) - 1)
+        result['busy'] = samples['busy'][before]
+
+        outside = (times < samples['time'][0]) | (times > samples['time'][-1])
+        result['stepPosition'][outside] = np.nan
+        result['position'][outside] = np.nan
+        return result
+
+    def window(self, startTime, endTime):
+        """
+        Returns the samples taken between startTime and endTime, as a
+        structured array
+        """
+        samples = self.buffer.array()
+        first = np.searchsorted(samples['time'], startTime, side='left')
+        last = np.searchsorted(samples['time'], endTime, side='right')
+        return samples[first:last]
@@ -0,0 +1,143 @@
+# profileBundle.py
+#
+# Stage profiles from the bundle built by genProfiles.py, in place of the
+# libximc python profile scripts. Listing the profiles reads the index
+# only; loading one reads and decompresses its record and unpacks the
+# settings structs from it, with no Python to compile.
+#
+#   bundle = ProfileBundle()
+#   bundle.apply(lib, stageDev, '8MT173-25-MEn1')
+#
+# apply_changes() reads the controller's settings first and writes only
+# those that differ from the profile, so applying a profile the stage
+# already has costs one read per setting and, if the controller reads back
+# what was written, no writes. Checked on a libximc virtual controller
+# only, which does not support engine_advansed_setup and
+# extended_settings, so those two are written every time there.
+
+import os
+import json
+import zlib
+from ctypes import *
+
+import ximcPath
+import pyximc
+from pyximc import Result
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+BUNDLE_VERSION = 1
+
+def same_settings(a, b):
+    """
+    Returns True if two settings structs of the same type hold the same
+    field values. Padding and Reserved* fields are not compared, and char
+    arrays are compared as strings, up to their first NUL, as the
+    controller need not keep the bytes after it.
+    """
+    dataA = bytes(a)
+    dataB = bytes(b)
+    for fieldName, fieldType in type(a)._fields_:
+        if fieldName.startswith('Reserved'):
+            continue
+        if issubclass(fieldType, Array) and fieldType._type_ is c_char:
+            if getattr(a, fieldName) != getattr(b, fieldName):
+                return False
+            continue
+        desc = getattr(type(a), fieldName)
+        if dataA[desc.offset:desc.offset + desc.size] != dataB[desc.offset:desc.offset + desc.size]:
+            return False
+    return True
+
+def _rank(worst_result, result):
+    """
+    Returns the worse of two results, ranked as the profile scripts do:
+    the first error is kept, except that a ValueError gives way to any
+    other error.
+    """
+    if result != Result.Ok:
+        if worst_result == Result.Ok or worst_result == Result.ValueError:
+            return result
+    return worst_result
+
+class ProfileBundle:
+    def __init__(self, name='STANDA', directory=PROFILE_DIR):
+        """
+        Input:
+        - name          bundle name, ie. the python-profiles directory it
+                        was built from
+        - directory     where genProfiles.py wrote it
+        """
+        self.path = os.path.join(directory, f'{name}.bin')
+        with open(os.path.join(directory, f'{name}.json')) as f:
+            index = json.load(f)
+        if index['version'] != BUNDLE_VERSION:
+            raise ValueError(f'{name}: bundle version {index["version"]}, expected {BUNDLE_VERSION}')
+
+        # [(setter name, struct type)], the same for every profile
+        self.layout = []
+        for setter, structName, size in index['layout']:
+            structType = getattr(pyximc, structName)
+            if sizeof(structType) != size:
+                raise ValueError(f'{name}: {structName} does not match pyximc, run genProfiles.py again')
+            self.layout.append((setter, structType))
+        self.profiles = index['profiles']
+
+    def __contains__(self, name):
+        return name in self.profiles
+
+    def names(self):
+        return sorted(self.profiles)
+
+    def load(self, name):
+        """
+        Returns the settings of a profile: [(setter name, struct)], in the
+        order the profile script writes them. Raises KeyError for an
+        unknown profile.
+        """
+        offset, length = self.profiles[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length))
+
+        settings = []
+        pos = 0
+        for setter, structType in self.layout:
+            settings.append((setter, structType.from_buffer_copy(data, pos)))
+            pos += sizeof(structType)
+        return settings
+
+    def apply(self, lib, dev, name):
+        """
+        Writes a profile to a controller, as its set_profile_*(lib, id)
+        script does.
+
+        Output:
+        - the worst result of the writes, ranked like the scripts do
+        """
+        worst_result = Result.Ok
+        for setter, settings in self.load(name):
+            result = getattr(lib, setter)(dev, byref(settings))
+            worst_result = _rank(worst_result, result)
+        return worst_result
+
+    def apply_changes(self, lib, dev, name):
+        """
+        Writes only the settings of a profile that differ from those on the
+        controller. Settings that cannot be read are written.
+
+        Output:
+        - worst_result  the worst result of the writes, as for apply()
+        - changed       names of the settings written, ie. 'move_settings'
+        """
+        worst_result = Result.Ok
+        changed = []
+        for setter, settings in self.load(name):
+            current = type(settings)()
+            result = getattr(lib, 'get_' + setter[4:])(dev, byref(current))
+            if result == Result.Ok and same_settings(current, settings):
+                continue
+
+            changed.append(setter[4:])
+            result = getattr(lib, setter)(dev, byref(settings))
+            worst_result = _rank(worst_result, result)
+        return worst_result, changed
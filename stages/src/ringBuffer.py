@@ -0,0 +1,56 @@
+# ringBuffer.py
+#
+# Fixed-size ring buffer of records, backed by a NumPy structured array,
+# for the per-axis capture and history buffers. Once full, each new record
+# replaces the oldest.
+
+import numpy as np
+
+class RingBuffer:
+    def __init__(self, size, dtype):
+        """
+        Input:
+        - size      Number of records kept
+        - dtype     NumPy dtype of one record
+        """
+        self.data = np.zeros(size, dtype=dtype)
+        self.size = size
+        self.count = 0  # records written since the last clear()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, record):
+        """
+        Adds one record, given as a tuple in dtype field order
+        """
+        self.data[self.count % self.size] = record
+        self.count += 1
+
+    def extend(self, records):
+        """
+        Adds a structured array of records, oldest first
+        """
+        n = len(records)
+        if n >= self.size:
+            records = records[n - self.size:]
+            self.count += n - self.size
+            n = self.size
+
+        start = self.count % self.size
+        first = min(n, self.size - start)
+        self.data[start:start + first] = records[:first]
+        self.data[:n - first] = records[first:]
+        self.count += n
+
+    def array(self):
+        """
+        Returns a copy of the records held, oldest first
+        """
+        if self.count <= self.size:
+            return self.data[:self.count].copy()
+        start = self.count % self.size
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+    def clear(self):
+        self.count = 0
@@ -0,0 +1,172 @@
+# sequencer.py
+#
+# Server-side multi-axis sequences. A client uploads a list of waypoints
+# with the 'sequence' command and the server steps through them on the
+# Stage objects, so each step follows the last at hardware speed rather
+# than at client round-trip speed.
+#
+#   sequence,<step>,<step>,...
+#       Each step is a space separated list of axis targets (real units)
+#       and options, ie. 'a=-90 c=50 dwell=0.5':
+#       - dwell=<s>     wait this long after the step
+#       - nowait        do not wait for the axes to stop before the dwell
+#   sequence,status     OK,RUNNING,<step>,<steps> or OK,IDLE
+#   sequence,abort      stops the sequence and its axes
+#
+# A stop of any axis the sequence moves aborts the sequence too. A step
+# the sequence waits on only counts as done once each of its axes has
+# stopped within tolerance steps of its target; one that stopped short
+# (ie. at a limit switch) fails the sequence.
+#
+# Progress is sent to the client that started the sequence as events:
+# SEQ,START,<steps>  SEQ,STEP,<step>,<steps>  SEQ,DONE
+# SEQ,ABORTED,<step>  SEQ,FAILED,<step>,<reason>
+
+import logging
+import asyncio
+import time
+
+from backgroundTasks import spawn
+
+class Sequencer:
+    def __init__(self, axes, poller, submit, pollInterval=0.01, tolerance=1.0):
+        """
+        Input:
+        - axes          dict of axis name -> Stage
+        - poller        StatusPoller, whose snapshots are updated as we wait
+        - submit        CMDLoop.submit, to queue moves on the axis lanes
+        - pollInterval  seconds between status reads of moving axes
+        - tolerance     steps an axis may stop from its waypoint
+        """
+        self.logger = logging.getLogger('stages')
+        self.axes = axes
+        self.poller = poller
+        self.submit = submit
+        self.pollInterval = pollInterval
+        self.tolerance = tolerance
+        self.task = None
+        self.step = 0
+        self.steps = 0
+        self.stages = []
+
+    def command(self, args, notify):
+        """
+        Handles the arguments of a 'sequence' command.
+
+        Output:
+        - The reply string
+        """
+        if args == ['status']:
+            if self.running():
+                return f'OK,RUNNING,{self.step},{self.steps}'
+            return 'OK,IDLE'
+
+        elif args == ['abort']:
+            if not self.running():
+                return 'BAD, no sequence running'
+            self.abort(self.stages)
+            for stage in self.stages:
+                spawn(stage.stop_async())
+            return 'OK'
+
+        try:
+            steps = [self.parse_step(step) for step in args]
+        except (KeyError, ValueError) as e:
+            return f'BAD, invalid sequence step: {e}'
+        if len(steps) == 0:
+            return 'BAD, empty sequence'
+
+        if self.running():
+            return 'BAD, sequence already running'
+
+        self.step = 0
+        self.steps = len(steps)
+        self.stages = list({stage for step in steps for name, stage, val in step[0]})
+        self.task = asyncio.create_task(self.run(steps, notify))
+        return 'OK'
+
+    def parse_step(self, step):
+        """
+        Returns (moves, dwell, wait) for one step, moves being a list of
+        (name, stage, position). Raises KeyError or ValueError.
+        """
+        moves = []
+        dwell = 0.0
+        wait = True
+
+        for token in step.split():
+            key, sep, val = token.partition('=')
+            if token == 'nowait':
+                wait = False
+            elif key == 'dwell':
+                dwell = float(val)
+                if dwell < 0:
+                    raise ValueError(f'negative dwell {token!r}')
+            elif sep and key in self.axes and self.axes[key]:
+                moves.append((key, self.axes[key], float(val)))
+            else:
+                raise KeyError(token)
+
+        return moves, dwell, wait
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def abort(self, stages):
+        """
+        Cancels the running sequence if it moves any of the given stages.
+        Stopping them is left to the caller.
+        """
+        if self.running() and any(stage in self.stages for stage in stages):
+            self.task.cancel()
+
+    async def run(self, steps, notify):
+        notify(f'SEQ,START,{len(steps)}')
+        try:
+            for i, (moves, dwell, wait) in enumerate(steps):
+                self.step = i + 1
+
+                futures = [self.submit(stage, stage.goto_real_async, val) for name, stage, val in moves]
+                results = await asyncio.gather(*futures)
+                failed = [name for (name, stage, val), result in zip(moves, results) if 'BAD' in result]
+                if failed:
+                    notify(f'SEQ,FAILED,{self.step},move failed on {"/".join(failed)}')
+                    return
+
+                if wait:
+                    stopped = await asyncio.gather(*[self.wait_idle(stage) for name, stage, val in moves])
+                    missed = [f'{name} at {stageStatus.position}{stage.units}'
+                              for (name, stage, val), stageStatus in zip(moves, stopped)
+                              if abs(stageStatus.stepPosition - val / stage.conversionFactor) > self.tolerance]
+                    if missed:
+                        notify(f'SEQ,FAILED,{self.step},waypoint missed: {", ".join(missed)}')
+                        return
+                if dwell > 0:
+                    await asyncio.sleep(dwell)
+
+                notify(f'SEQ,STEP,{self.step},{len(steps)}')
+
+            notify('SEQ,DONE')
+
+        except asyncio.CancelledError:
+            notify(f'SEQ,ABORTED,{self.step}')
+            raise
+
+        except Exception as e:
+            self.logger.error(f'sequence failed: {e}')
+            notify(f'SEQ,FAILED,{self.step},{e}')
+
+    async def wait_idle(self, stage):
+        """
+        Reads the status of a moving Stage every pollInterval until it is
+        IDLE. The reads also refresh the poller's snapshot and wake its
+        waiters.
+        """
+        since = time.time()
+        while True:
+            response, stageStatus = await self.poller.sample(stage)
+            if response != 'OK':
+                raise RuntimeError(f'{stage.name}: {response}')
+            if stageStatus.moveState == 'IDLE' and stageStatus.time > since:
+                return stageStatus
+            await asyncio.sleep(self.pollInterval)
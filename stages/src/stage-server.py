@@ -898,7 +898,7 @@ if __name__ == "__main__":
                 log.info('\n...Closing server...')
                 for n in open_devs:
                     tempStage = n.stageDev
-                    lib.close_device(byref(cast(n, POINTER(c_int))))
+                    lib.close_device(byref(c_int(tempStage)))
                 log.info('Done')
             except:
                 log.error('Unknown error')
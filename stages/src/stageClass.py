@@ -9,14 +9,46 @@ import logging
 import sys
 import os
 import math
+import asyncio
+import functools
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import *
 
 cur_dir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 os.chdir(cur_dir)
-ximcDir = (f'{cur_dir}/ximc-2.13.3/ximc')
-ximcPackageDir = os.path.join(ximcDir, "crossplatform", "wrappers", "python")
-sys.path.append(ximcPackageDir)
+import ximcPath
 from pyximc import *
+import ximcPrototypes
+import ximcDtypes
+
+# declare argtypes/restype for the whole libximc API (see genPrototypes.py).
+# This is for correct argument and return types, not speed: the declared
+# calls measure a little slower than undeclared ones (benchXimc.py)
+ximcPrototypes.declare(lib)
+
+# One sample of a controller's state, taken from a single status_t read.
+# time is time.time() at the read, positions are in steps except position
+# (real units), speed is in steps/s.
+StageStatus = namedtuple('StageStatus', ['time', 'moveState', 'mvCmdSts',
+                                         'stepPosition', 'encPosition', 'position',
+                                         'speed', 'flags', 'cmdBufFreeSpace'])
+
+def move_state(mvCmdSts):
+    """
+    Returns BUSY/IDLE for the MvCmdSts field of status_t. Any running
+    command counts as BUSY, homing included.
+    """
+    if mvCmdSts & MvcmdStatus.MVCMD_RUNNING:
+        return 'BUSY'
+    else:
+        return 'IDLE'
+
+class StageOffline(ConnectionError):
+    """
+    Raised for calls to a Stage whose controller is disconnected
+    """
 
 class Stage:
     def __init__(self, lib, deviceID, name, softStops, homeOffset, conversionFactor, units):
@@ -29,7 +61,249 @@ class Stage:
         self.conversionFactor = conversionFactor
         self.units = units
 
-        self.stageDev = self.lib.open_device(deviceID)
+        # every libximc call for this controller runs on this one thread, so
+        # calls are serialized per device and never block the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+        # deviceID None: the device was not found, it is opened later
+        if deviceID is not None:
+            self.stageDev = self.lib.open_device(deviceID)
+        else:
+            self.stageDev = -1
+        self.online = self.stageDev > 0
+
+        # consecutive failed status reads, for the Supervisor. A failed call
+        # of any kind is followed by a status read, see checked()
+        self.failures = 0
+
+        # out-structs for the frequent reads, allocated once with their byref
+        # pointers. Only used on the worker thread, where calls to this
+        # device are serialized, so they are never in use twice at once.
+        # Values are copied out before the reads return
+        self.statusBuf = status_t()
+        self.statusRef = byref(self.statusBuf)
+        self.positionBuf = get_position_t()
+        self.positionRef = byref(self.positionBuf)
+
+        # write-through cache of the device settings, loaded at open and
+        # updated on every write the controller accepts, so it always holds
+        # what the device has. The move settings are also restored from it
+        # after a reconnect
+        self.moveSettings = None
+        self.homeSettings = None
+        self.engineSettings = None
+
+        # settings whose write failed other than by being rejected (ie. the
+        # USB link dropped), to write again after a reconnect:
+        # {cache attr: (setter, settings)}
+        self.pendingSettings = {}
+        if self.online:
+            self.load_settings()
+
+    async def run(self, func, *args):
+        """
+        Runs a blocking method on this device's worker thread. Raises
+        StageOffline if the controller is disconnected.
+
+        Input:
+        - func      The method to call
+        - args      Arguments for func
+
+        Output:
+        - The return value of func
+        """
+        if not self.online:
+            raise StageOffline(f'{self.name} is offline')
+        return await self.execute(self.checked, func, *args)
+
+    def checked(self, func, *args):
+        """
+        Calls func and, if it fails, reads the status as well. A controller
+        that dropped off then counts a failure whichever call found it,
+        while one that only rejected the command reads fine and counts none.
+        """
+        retData = func(*args)
+        response = retData[0] if isinstance(retData, tuple) else retData
+        if isinstance(response, str) and response.startswith('BAD') and \
+                func != self.read_status and func != self.read_status_into:
+            self.read_status()
+        return retData
+
+    async def execute(self, func, *args):
+        """
+        Runs a blocking method on this device's worker thread, online or not.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def close(self):
+        """
+        Stops the worker thread once its queued calls are done.
+        """
+        self.executor.shutdown(wait=True)
+
+    def close_device(self):
+        """
+        Closes the controller handle and marks the Stage offline.
+        """
+        self.online = False
+        if self.stageDev > 0:
+            lib.close_device(byref(c_int(self.stageDev)))
+        self.stageDev = -1
+
+    def reopen(self, deviceID=None):
+        """
+        Opens the controller again, at deviceID if given (ie. after it was
+        found at a new URI), and restores its move settings.
+
+        Output:
+        - OK/BAD
+        """
+        if deviceID is not None:
+            self.deviceID = deviceID
+        if self.deviceID is None:
+            return 'BAD: no device URI'
+
+        if self.stageDev > 0:
+            self.close_device()
+        self.stageDev = self.lib.open_device(self.deviceID)
+        if self.stageDev <= 0:
+            return 'BAD: open_device() failed'
+
+        response = 'OK'
+        if self.moveSettings is not None:
+            response = self.restore_move_settings()
+        if response == 'OK':
+            response = self.restore_pending_settings()
+        if response == 'OK':
+            response = self.load_settings()
+
+        if response == 'OK':
+            self.failures = 0
+            self.online = True
+        else:
+            self.close_device()
+        return response
+
+    def load_settings(self):
+        """
+        Reads the move, home and engine settings of the device into the
+        cache.
+
+        Output:
+        - OK/BAD
+        """
+        response = 'OK'
+        for attr, getter, settingsType in (('moveSettings', lib.get_move_settings, move_settings_t),
+                                           ('homeSettings', lib.get_home_settings, home_settings_t),
+                                           ('engineSettings', lib.get_engine_settings, engine_settings_t)):
+            settings = settingsType()
+            result = getter(self.stageDev, byref(settings))
+            if result == Result.Ok:
+                setattr(self, attr, settings)
+            else:
+                setattr(self, attr, None)
+                response = f'BAD: {getter.__name__}() failed'
+        return response
+
+    def cached_settings(self, attr, getter, settingsType):
+        """
+        Returns a copy of the cached settings in attr, reading them from the
+        device with getter if they are not cached.
+
+        Output:
+        - response      OK/BAD
+        - settings      settingsType struct
+        """
+        settings = getattr(self, attr)
+        if settings is None:
+            settings = settingsType()
+            result = getter(self.stageDev, byref(settings))
+            if result != Result.Ok:
+                return f'BAD: {getter.__name__}() failed', settings
+            setattr(self, attr, settings)
+        return 'OK', settingsType.from_buffer_copy(settings)
+
+    def write_settings(self, attr, setter, settings):
+        """
+        Writes settings to the device with setter, and to the cache in attr
+        once the device has taken them. If the write fails other than by
+        the controller rejecting the values (ie. the USB link dropped), the
+        settings are kept in pendingSettings instead, for reopen() to write
+        again.
+
+        Output:
+        - OK/BAD
+        """
+        result = setter(self.stageDev, byref(settings))
+        if result == Result.Ok:
+            setattr(self, attr, type(settings).from_buffer_copy(settings))
+            self.pendingSettings.pop(attr, None)
+            return 'OK'
+        elif result != Result.ValueError:
+            self.pendingSettings[attr] = (setter, type(settings).from_buffer_copy(settings))
+        return f'BAD: {setter.__name__}() failed'
+
+    def restore_pending_settings(self):
+        """
+        Writes the settings of pendingSettings again, after a reconnect.
+        Settings the controller now rejects are dropped, with an error
+        logged.
+
+        Output:
+        - OK, or BAD if a write failed again
+        """
+        response = 'OK'
+        for attr, (setter, settings) in list(self.pendingSettings.items()):
+            del self.pendingSettings[attr]
+            result = self.write_settings(attr, setter, settings)
+            if attr in self.pendingSettings:
+                response = result
+            elif result != 'OK':
+                self.logger.error(f'{self.name}: {result}, dropping the {attr} written before the reconnect')
+        return response
+
+    def apply_profile(self, bundle, name):
+        """
+        Writes a stage profile to the device and reloads the settings
+        cache from it.
+
+        Input:
+        - bundle        profileBundle.ProfileBundle
+        - name          profile name, ie. '8MT173-25-MEn1'
+
+        Output:
+        - OK/BAD
+        """
+        result = bundle.apply(lib, self.stageDev, name)
+        response = self.load_settings()
+        if result != Result.Ok:
+            response = f'BAD: profile {name} failed ({result})'
+        return response
+
+    def update_profile(self, bundle, name):
+        """
+        Writes the settings of a stage profile that differ from the
+        device's, and reloads the settings cache if any were written.
+
+        Output:
+        - response      OK/BAD
+        - changed       names of the settings written
+        """
+        result, changed = bundle.apply_changes(lib, self.stageDev, name)
+        response = 'OK'
+        if changed:
+            response = self.load_settings()
+        if result != Result.Ok:
+            response = f'BAD: profile {name} failed ({result})'
+        return response, changed
+
+    def restore_move_settings(self):
+        result = lib.set_move_settings(self.stageDev, byref(self.moveSettings))
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: set_move_settings() failed'
 
     def home(self):
         """
@@ -65,18 +339,54 @@ class Stage:
 
         return response
 
-    def get_home_settings(self):
-        response = 'OK'
-        hmst = home_settings_t()
-        
-        result = lib.get_home_settings(self.stageDev, byref(hmst))
-        
+    def start_home(self):
+        """
+        Starts homing the stage and returns straight away. The controller
+        reports MVCMD_HOME while it is homing.
+        """
+        result = lib.command_home(self.stageDev)
         if result == Result.Ok:
-            pass
+            return 'OK'
         else:
-            response = 'BAD: get_home_settings() failed'
+            return 'BAD: command_home failed'
 
-        return response, hmst
+    def finish_home(self, stageStatus):
+        """
+        Sets zero once homing started with start_home() is over.
+
+        Input:
+        - stageStatus   the first StageStatus sampled IDLE after start_home()
+
+        Output:
+        - OK, or BAD if homing failed or was stopped, and nothing is zeroed
+        """
+        if stageStatus.mvCmdSts & MvcmdStatus.MVCMD_ERROR:
+            return 'BAD: homing failed'
+        if stageStatus.mvCmdSts & MvcmdStatus.MVCMD_NAME_BITS != MvcmdStatus.MVCMD_HOME:
+            return 'BAD: homing stopped'
+        return self.zero()
+
+    def zero(self):
+        """
+        Sets the current position of the stage as zero.
+        """
+        result = lib.command_zero(self.stageDev)
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: command_zero failed'
+
+    def get_home_settings(self):
+        return self.cached_settings('homeSettings', lib.get_home_settings, home_settings_t)
+
+    def set_home_settings(self, hmst):
+        return self.write_settings('homeSettings', lib.set_home_settings, hmst)
+
+    def get_engine_settings(self):
+        return self.cached_settings('engineSettings', lib.get_engine_settings, engine_settings_t)
+
+    def set_engine_settings(self, engst):
+        return self.write_settings('engineSettings', lib.set_engine_settings, engst)
 
     def offset_steps(self, distance):
         currentPositionResp, currentPosition = self.get_enc_position()
@@ -141,10 +451,10 @@ class Stage:
         - OK/BAD
         """
 
-        mvst = move_settings_t()
-        result = lib.get_move_settings(self.stageDev, byref(mvst))
+        # the current settings come from the cache, so this is one write
+        response, mvst = self.get_move_settings()
 
-        if result == Result.Ok:
+        if response == 'OK':
             # split the integer from the decimal
             u_speed, speed = math.modf(speed)
 
@@ -154,13 +464,9 @@ class Stage:
             # prepare move_settings_t struct
             mvst.Speed = int(speed)
             mvst.uSpeed = int(u_speed)
-            result = lib.set_move_settings(self.stageDev, byref(mvst))
-            if result == Result.Ok:
-                return 'OK'
-            else:
-                return 'BAD: set_move_settings() failed'
+            return self.set_move_settings(mvst)
         else:
-            return 'BAD: get_move_settings() failed'
+            return response
 
     def get_speed(self):
         """
@@ -170,18 +476,92 @@ class Stage:
         - mvst.Speed    Speed in steps
         - mvst.uSpeed   Leftover uSteps
         """
-        response = 'OK'
-        mvst = move_settings_t()
-        result = lib.get_move_settings(self.stageDev, byref(mvst))
+        response, mvst = self.get_move_settings()
 
-        if result == Result.Ok:    
+        if response == 'OK':
             stageSpeed = (mvst.Speed, mvst.uSpeed)
         else:
             stageSpeed = (-999,-999)
-            response = 'BAD: get_move_settings() failed'
-        
+
         return response, stageSpeed
 
+    def get_sync_out_settings(self):
+        response = 'OK'
+        sost = sync_out_settings_t()
+        result = lib.get_sync_out_settings(self.stageDev, byref(sost))
+
+        if result == Result.Ok:
+            pass
+        else:
+            response = 'BAD: get_sync_out_settings() failed'
+
+        return response, sost
+
+    def set_sync_out_settings(self, sost):
+        result = lib.set_sync_out_settings(self.stageDev, byref(sost))
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: set_sync_out_settings() failed'
+
+    def enable_sync_out(self, period, pulseWidth=1):
+        """
+        Sets the sync output to pulse every period steps of travel.
+
+        Input:
+        - period        Pulse spacing in steps
+        - pulseWidth    Pulse length in steps
+
+        Output:
+        - OK/BAD
+        """
+        sost = sync_out_settings_t()
+        sost.SyncOutFlags = (SyncOutFlags.SYNCOUT_ENABLED | SyncOutFlags.SYNCOUT_IN_STEPS |
+                             SyncOutFlags.SYNCOUT_ONPERIOD)
+        sost.SyncOutPulseSteps = int(pulseWidth)
+        sost.SyncOutPeriod = int(period)
+        return self.set_sync_out_settings(sost)
+
+    def start_measurements(self):
+        """
+        Starts buffering speed and following error on the controller, one
+        sample per ms. Read them out with get_measurements().
+        """
+        result = lib.command_start_measurements(self.stageDev)
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: command_start_measurements failed'
+
+    def get_measurements(self):
+        """
+        Reads (and empties) the controller's measurement buffer.
+
+        Output:
+        - response      OK/BAD
+        - meas          measurements_t, with meas.Length samples
+        """
+        response = 'OK'
+        meas = measurements_t()
+        result = lib.get_measurements(self.stageDev, byref(meas))
+
+        if result == Result.Ok:
+            pass
+        else:
+            response = 'BAD: get_measurements() failed'
+
+        return response, meas
+
+    def get_move_settings(self):
+        """
+        Returns the move_settings_t of the device: speed, acceleration and
+        deceleration in steps/s and steps/s^2. From the cache.
+        """
+        return self.cached_settings('moveSettings', lib.get_move_settings, move_settings_t)
+
+    def set_move_settings(self, mvst):
+        return self.write_settings('moveSettings', lib.set_move_settings, mvst)
+
     def get_move_status(self):
         """
         Returns the moving status of the given device
@@ -190,22 +570,100 @@ class Stage:
         - BUSY/IDLE
         """
         response = 'OK'
-        deviceStatus = status_t()
-        result = lib.get_status(self.stageDev, byref(deviceStatus))
+        deviceStatus = self.statusBuf
+        result = lib.get_status(self.stageDev, self.statusRef)
 
         if result == Result.Ok:
-            moveComState = deviceStatus.MvCmdSts
-
-            if moveComState == 129:
-                stageStatus = 'BUSY'
-            else:
-                stageStatus = 'IDLE'
+            stageStatus = move_state(deviceStatus.MvCmdSts)
         else:
             response = 'BAD: get_status() failed'
             stageStatus = 'N/A'
         
         return response, stageStatus
 
+    def read_status(self):
+        """
+        Reads the full status of the device in one transaction
+
+        Output:
+        - response      OK/BAD
+        - stageStatus   StageStatus sample, or None
+        """
+        response = 'OK'
+        deviceStatus = self.statusBuf
+        result = lib.get_status(self.stageDev, self.statusRef)
+
+        if result == Result.Ok:
+            stageStatus = StageStatus(
+                time=time.time(),
+                moveState=move_state(deviceStatus.MvCmdSts),
+                mvCmdSts=deviceStatus.MvCmdSts,
+                stepPosition=deviceStatus.CurPosition + (deviceStatus.uCurPosition / 256),
+                encPosition=deviceStatus.EncPosition,
+                position=self.conversionFactor * deviceStatus.EncPosition,
+                speed=deviceStatus.CurSpeed + (deviceStatus.uCurSpeed / 256),
+                flags=deviceStatus.Flags,
+                cmdBufFreeSpace=deviceStatus.CmdBufFreeSpace)
+            self.failures = 0
+        else:
+            response = 'BAD: get_status() failed'
+            stageStatus = None
+            self.failures += 1
+
+        return response, stageStatus
+
+    def read_status_into(self, records, index):
+        """
+        Reads the status of the device straight into one row of a record
+        array, with no conversion of its fields.
+
+        Input:
+        - records       array of ximcDtypes.STATUS_RECORD_DTYPE
+        - index         row to fill: time and status
+
+        Output:
+        - OK/BAD
+        """
+        ref = ximcDtypes.struct_ref(records, index, 'status', status_t)
+        result = lib.get_status(self.stageDev, ref)
+        records['time'][index] = time.time()
+
+        if result == Result.Ok:
+            self.failures = 0
+            return 'OK'
+        else:
+            self.failures += 1
+            return 'BAD: get_status() failed'
+
+    def read_position_into(self, records, index):
+        """
+        Reads the position of the device into one row of an array of
+        ximcDtypes.POSITION_RECORD_DTYPE, like read_status_into(), but
+        leaves the failure count to the status reads.
+        """
+        ref = ximcDtypes.struct_ref(records, index, 'position', get_position_t)
+        result = lib.get_position(self.stageDev, ref)
+        records['time'][index] = time.time()
+
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: get_position() failed'
+
+    def read_measurements_record(self, records, index):
+        """
+        Reads (and empties) the measurement buffer into one row of an array
+        of ximcDtypes.MEASUREMENTS_RECORD_DTYPE, like read_status_into().
+        """
+        ref = ximcDtypes.struct_ref(records, index, 'measurements', measurements_t)
+        result = lib.get_measurements(self.stageDev, ref)
+        records['time'][index] = time.time()
+
+        if result == Result.Ok:
+            return 'OK'
+        else:
+            return 'BAD: get_measurements() failed'
+
     def get_step_position(self):
         """
         Returns the position of the device in steps
@@ -215,8 +673,8 @@ class Stage:
         - stagePosition Position of the stage   
         """
         response = 'OK'
-        stagePositionTmp = get_position_t()
-        result = lib.get_position(self.stageDev, byref(stagePositionTmp))
+        stagePositionTmp = self.positionBuf
+        result = lib.get_position(self.stageDev, self.positionRef)
 
         if result == Result.Ok:
             # Convert the position from steps to readable units (conversionFactor)
@@ -236,8 +694,8 @@ class Stage:
         - stagePosition Position of the stage   
         """
         response = 'OK'
-        stagePositionTmp = get_position_t()
-        result = lib.get_position(self.stageDev, byref(stagePositionTmp))
+        stagePositionTmp = self.positionBuf
+        result = lib.get_position(self.stageDev, self.positionRef)
 
         if result == Result.Ok:
             stagePosition = stagePositionTmp.EncPosition
@@ -266,6 +724,26 @@ class Stage:
 
         return response, stagePosition
 
+    def get_serial_number(self):
+        """
+        Returns the serial number of the controller
+
+        Output:
+        - response      OK/BAD
+        - serial        Serial number, as in the device URI (in hex)
+        """
+        response = 'OK'
+        serial = c_uint()
+        result = lib.get_serial_number(self.stageDev, byref(serial))
+
+        if result == Result.Ok:
+            stageSerial = serial.value
+        else:
+            response = 'BAD: get_serial_number() failed'
+            stageSerial = -999
+
+        return response, stageSerial
+
     def get_units(self):
         return self.units
 
@@ -274,4 +752,112 @@ class Stage:
         if result == Result.Ok:
             return 'OK'
         else:
-            return 'BAD: Soft stop failed'
\ No newline at end of file
+            return 'BAD: Soft stop failed'
+
+    #### Async API ###################################
+    # await-able versions of the methods above, run on the device's thread
+
+    async def start_home_async(self):
+        """
+        Starts homing the stage like home(), but with command_home instead
+        of the blocking command_homezero, so the device's thread is free
+        while it homes. Once the stage is IDLE again, finish with
+        finish_home_async().
+        """
+        respHmst, hmst = await self.run(self.get_home_settings)
+        if respHmst != 'OK':
+            return respHmst
+        return await self.run(self.start_home)
+
+    async def finish_home_async(self, stageStatus):
+        return await self.run(self.finish_home, stageStatus)
+
+    async def get_home_settings_async(self):
+        return await self.run(self.get_home_settings)
+
+    async def offset_steps_async(self, distance):
+        return await self.run(self.offset_steps, distance)
+
+    async def goto_steps_async(self, position):
+        return await self.run(self.goto_steps, position)
+
+    async def offset_real_async(self, distance):
+        return await self.run(self.offset_real, distance)
+
+    async def goto_real_async(self, position):
+        return await self.run(self.goto_real, position)
+
+    async def set_speed_async(self, speed):
+        return await self.run(self.set_speed, speed)
+
+    async def get_speed_async(self):
+        return await self.run(self.get_speed)
+
+    async def get_sync_out_settings_async(self):
+        return await self.run(self.get_sync_out_settings)
+
+    async def set_sync_out_settings_async(self, sost):
+        return await self.run(self.set_sync_out_settings, sost)
+
+    async def enable_sync_out_async(self, period, pulseWidth=1):
+        return await self.run(self.enable_sync_out, period, pulseWidth)
+
+    async def start_measurements_async(self):
+        return await self.run(self.start_measurements)
+
+    async def get_measurements_async(self):
+        return await self.run(self.get_measurements)
+
+    async def get_move_settings_async(self):
+        return await self.run(self.get_move_settings)
+
+    async def set_move_settings_async(self, mvst):
+        return await self.run(self.set_move_settings, mvst)
+
+    async def apply_profile_async(self, bundle, name):
+        return await self.run(self.apply_profile, bundle, name)
+
+    async def update_profile_async(self, bundle, name):
+        return await self.run(self.update_profile, bundle, name)
+
+    async def set_home_settings_async(self, hmst):
+        return await self.run(self.set_home_settings, hmst)
+
+    async def get_engine_settings_async(self):
+        return await self.run(self.get_engine_settings)
+
+    async def set_engine_settings_async(self, engst):
+        return await self.run(self.set_engine_settings, engst)
+
+    async def get_move_status_async(self):
+        return await self.run(self.get_move_status)
+
+    async def read_status_async(self):
+        return await self.run(self.read_status)
+
+    async def read_status_into_async(self, records, index):
+        return await self.run(self.read_status_into, records, index)
+
+    async def read_position_into_async(self, records, index):
+        return await self.run(self.read_position_into, records, index)
+
+    async def read_measurements_record_async(self, records, index):
+        return await self.run(self.read_measurements_record, records, index)
+
+    async def get_step_position_async(self):
+        return await self.run(self.get_step_position)
+
+    async def get_enc_position_async(self):
+        return await self.run(self.get_enc_position)
+
+    async def get_position_async(self):
+        return await self.run(self.get_position)
+
+    async def stop_async(self):
+        return await self.run(self.stop)
+
+    async def close_device_async(self):
+        return await self.execute(self.close_device)
+
+    async def reopen_async(self, deviceID=None):
+        return await self.execute(self.reopen, deviceID)
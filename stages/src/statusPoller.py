@@ -0,0 +1,121 @@
+# statusPoller.py
+#
+# The Status Poller loop. It runs in parallel with the Command Handler and
+# reads one status_t per axis at a fixed rate. The latest sample for each
+# Stage is kept as a timestamped StageStatus, so status queries from any
+# number of clients are answered without extra USB transactions. Clients
+# waiting for a move to finish are woken from the same samples, and every
+# sample is added to the position history of its Stage. While reads of
+# a Stage fail, its snapshot is stale and queries get the failure instead.
+
+import logging
+import asyncio
+import time
+
+from positionHistory import PositionHistory
+
+class StatusPoller:
+    def __init__(self, openDevs, rate, historySize=36000):
+        self.logger = logging.getLogger('stages')
+        self.stages = [stage for stage in openDevs if stage]
+        self.period = 1 / rate
+        self.snapshots = {}
+        # Stage -> response of the last read, while its reads are failing
+        self.failed = {}
+        self.waiters = {}
+        # every sample is also kept in a position history per Stage
+        self.histories = {stage: PositionHistory(historySize) for stage in self.stages}
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            startTime = loop.time()
+            await asyncio.gather(*[self.sample(stage) for stage in self.stages if stage.online])
+            await asyncio.sleep(max(0, self.period - (loop.time() - startTime)))
+
+    async def sample(self, stage):
+        """
+        Reads the status of one Stage and stores it as the latest snapshot.
+
+        Output:
+        - response      OK/BAD
+        - stageStatus   StageStatus sample, or None
+        """
+        try:
+            response, stageStatus = await stage.read_status_async()
+        except ConnectionError as e:
+            return f'BAD: {e}', None
+
+        if response == 'OK':
+            if self.failed.pop(stage, None) is not None:
+                self.logger.info(f'{stage.name}: status reads working again')
+            self.snapshots[stage] = stageStatus
+            self.histories[stage].append(stageStatus)
+            self.notify_waiters(stage, stageStatus)
+        else:
+            # logged once, when the reads start failing
+            if stage not in self.failed:
+                self.logger.error(f'{stage.name}: {response}')
+            self.failed[stage] = response
+
+        return response, stageStatus
+
+    async def get_status(self, stage, fresh=False):
+        """
+        Returns the latest snapshot for a Stage. The device is read if
+        fresh is set or if it has not been sampled yet. While its reads are
+        failing, the last failure is returned instead of the stale snapshot.
+
+        Output:
+        - response      OK/BAD
+        - stageStatus   StageStatus sample, or None
+        """
+        if fresh or stage not in self.snapshots:
+            return await self.sample(stage)
+        elif stage in self.failed:
+            return self.failed[stage], None
+        else:
+            return 'OK', self.snapshots[stage]
+
+    def latest(self, stage):
+        """
+        Returns the latest StageStatus of a Stage, or None if it has none
+        or its reads are failing.
+        """
+        if stage in self.failed:
+            return None
+        return self.snapshots.get(stage)
+
+    def wait_idle(self, stage):
+        """
+        Returns a future that resolves to the first StageStatus of the Stage
+        sampled after this call that shows it IDLE.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault(stage, []).append((time.time(), future))
+        return future
+
+    def forget(self, stage):
+        """
+        Drops the snapshot of a Stage that went offline and fails anything
+        waiting for it to be IDLE.
+        """
+        self.snapshots.pop(stage, None)
+        self.failed.pop(stage, None)
+        for since, future in self.waiters.pop(stage, []):
+            if not future.done():
+                future.set_exception(ConnectionError(f'{stage.name} went offline'))
+
+    def notify_waiters(self, stage, stageStatus):
+        if stageStatus.moveState != 'IDLE':
+            return
+
+        waiting = []
+        for since, future in self.waiters.get(stage, []):
+            if future.done():
+                continue
+            if stageStatus.time > since:
+                future.set_result(stageStatus)
+            else:
+                waiting.append((since, future))
+        self.waiters[stage] = waiting
@@ -0,0 +1,163 @@
+# streamer.py
+#
+# Trajectory streaming. A client queues target positions for an axis with
+# the 'stream' command and the server keeps the controller's command
+# buffer fed from that queue, so the axis runs through the points without
+# stopping to settle at each one. Flow control comes from CmdBufFreeSpace
+# in status_t: a point is only sent while the buffer has room. A
+# controller that reports no room while IDLE is sent one point at a time.
+#
+#   stream,<axis>,<p>,<p>,...   queue points (real units), starting the
+#                               stream if it is not running
+#   stream,<axis>,status        OK,RUNNING,<queued>,<sent> or OK,IDLE
+#   stream,<axis>,abort         drops the queued points and stops the axis
+#
+# A stop of the axis aborts its stream the same way.
+#
+# Progress is sent to the client that started the stream as events:
+# STREAM,<axis>,DONE,<sent>  STREAM,<axis>,ABORTED,<sent>
+# STREAM,<axis>,FAILED,<sent>,<reason>
+
+import logging
+import asyncio
+import time
+from collections import deque
+
+from backgroundTasks import spawn
+
+class AxisStream:
+    """
+    The queue of points and the feeding task of one axis
+    """
+    def __init__(self):
+        self.points = deque()
+        self.sent = 0
+        self.task = None
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+class Streamer:
+    def __init__(self, axes, poller, submit, pollInterval=0.01, reserve=1, maxPoints=10000):
+        """
+        Input:
+        - axes          dict of axis name -> Stage
+        - poller        StatusPoller, whose snapshots are updated as we feed
+        - submit        CMDLoop.submit, to queue moves on the axis lanes
+        - pollInterval  seconds between status reads of a streaming axis
+        - reserve       buffer cells left free for other commands, ie. stop
+        - maxPoints     most points queued for one axis
+        """
+        self.logger = logging.getLogger('stages')
+        self.axes = axes
+        self.poller = poller
+        self.submit = submit
+        self.pollInterval = pollInterval
+        self.reserve = reserve
+        self.maxPoints = maxPoints
+        self.streams = {}
+
+    def command(self, args, notify):
+        """
+        Handles the arguments of a 'stream' command.
+
+        Output:
+        - The reply string
+        """
+        if len(args) < 2:
+            return 'BAD, invalid stream command'
+
+        name = args[0]
+        stage = self.axes.get(name)
+        if not stage:
+            return 'BAD, invalid stage selection'
+        stream = self.streams.setdefault(name, AxisStream())
+
+        if args[1:] == ['status']:
+            if stream.running():
+                return f'OK,RUNNING,{len(stream.points)},{stream.sent}'
+            return 'OK,IDLE'
+
+        elif args[1:] == ['abort']:
+            if not stream.running():
+                return 'BAD, no stream running'
+            self.abort([stage])
+            spawn(stage.stop_async())
+            return 'OK'
+
+        try:
+            points = [float(point) for point in args[1:]]
+        except ValueError as e:
+            return f'BAD, invalid stream point: {e}'
+        low, high = stage.softStops
+        for point in points:
+            if point < low or point > high:
+                return f'BAD, stream point {point} outside soft stops {stage.softStops}'
+        if len(stream.points) + len(points) > self.maxPoints:
+            return f'BAD, more than {self.maxPoints} points queued'
+
+        stream.points.extend(points)
+        if not stream.running():
+            stream.sent = 0
+            stream.task = asyncio.create_task(self.run(name, stage, stream, notify))
+        return 'OK'
+
+    def abort(self, stages):
+        """
+        Drops the queued points of the streams of the given stages and
+        cancels them. Stopping the axes is left to the caller.
+        """
+        for name, stream in self.streams.items():
+            if stream.running() and self.axes[name] in stages:
+                stream.points.clear()
+                stream.task.cancel()
+
+    async def run(self, name, stage, stream, notify):
+        """
+        Feeds the queued points of one axis to its controller as the command
+        buffer frees up, until they are all sent and the axis is IDLE.
+        """
+        since = time.time()
+        try:
+            while True:
+                response, stageStatus = await self.poller.sample(stage)
+                if response != 'OK':
+                    raise RuntimeError(response)
+
+                idle = stageStatus.moveState == 'IDLE' and stageStatus.time > since
+                if len(stream.points) == 0:
+                    if idle:
+                        break
+                else:
+                    room = stageStatus.cmdBufFreeSpace - self.reserve
+                    if room <= 0 and idle:
+                        room = 1
+                    if room > 0:
+                        await self.send(stage, stream, room)
+                        since = time.time()
+                        continue
+
+                await asyncio.sleep(self.pollInterval)
+
+            notify(f'STREAM,{name},DONE,{stream.sent}')
+
+        except asyncio.CancelledError:
+            notify(f'STREAM,{name},ABORTED,{stream.sent}')
+            raise
+
+        except Exception as e:
+            self.logger.error(f'{name}: stream failed: {e}')
+            stream.points.clear()
+            notify(f'STREAM,{name},FAILED,{stream.sent},{e}')
+
+    async def send(self, stage, stream, count):
+        """
+        Sends up to count queued points to the controller, through the axis
+        lane so they stay in order with other commands to the axis.
+        """
+        points = [stream.points.popleft() for i in range(min(count, len(stream.points)))]
+        futures = [self.submit(stage, stage.goto_real_async, point) for point in points]
+        for result in await asyncio.gather(*futures):
+            if 'BAD' in result:
+                raise RuntimeError(result)
+            stream.sent += 1
@@ -0,0 +1,94 @@
+# supervisor.py
+#
+# The Supervisor loop. It runs in parallel with the Status Poller and
+# watches the health of every controller. A Stage whose status reads keep
+# failing (or that was missing at startup) is taken offline: its snapshot
+# is dropped, so clients see it as OFFLINE, and calls to it fail straight
+# away instead of timing out. It is then reopened in the background, at
+# its last URI or wherever a USB probe finds it, and its move settings are
+# restored. The other stages carry on as normal throughout.
+#
+# Any failed call to a Stage is followed by a status read (see
+# Stage.checked), so a controller that drops off during a command counts
+# toward going offline straight away, not only at the next poll.
+
+import logging
+import asyncio
+import time
+
+class Supervisor:
+    def __init__(self, axes, poller, interval=1.0, maxFailures=3, retryInterval=2.0,
+                 locate=None, probeInterval=30.0):
+        """
+        Input:
+        - axes          dict of axis name -> Stage
+        - poller        StatusPoller holding the snapshots
+        - interval      seconds between health checks
+        - maxFailures   consecutive failed status reads before a Stage is
+                        taken offline
+        - retryInterval seconds between attempts to reopen an offline Stage
+        - locate        optional blocking function(stage) returning the
+                        current URI of its controller (a USB probe), or None
+        - probeInterval minimum seconds between calls to locate
+        """
+        self.logger = logging.getLogger('stages')
+        self.axes = axes
+        self.poller = poller
+        self.interval = interval
+        self.maxFailures = maxFailures
+        self.retryInterval = retryInterval
+        self.locate = locate
+        self.probeInterval = probeInterval
+        self.lastProbe = 0.0
+        self.reconnecting = {}
+
+    async def start(self):
+        while True:
+            await asyncio.gather(*[self.check(name, stage) for name, stage in self.axes.items() if stage])
+            await asyncio.sleep(self.interval)
+
+    async def check(self, name, stage):
+        """
+        Health check of one Stage. The poller's samples count as checks;
+        the device is only read here if it has not been sampled lately.
+        """
+        if stage.online:
+            stageStatus = self.poller.snapshots.get(stage)
+            if stageStatus is None or time.time() - stageStatus.time > self.interval:
+                await self.poller.sample(stage)
+
+            if stage.failures >= self.maxFailures:
+                self.logger.error(f'{name}: {stage.failures} failed status reads, taking {stage.name} offline')
+                await self.take_offline(stage)
+
+        if not stage.online and stage not in self.reconnecting:
+            self.reconnecting[stage] = asyncio.create_task(self.reconnect(name, stage))
+
+    async def take_offline(self, stage):
+        stage.online = False
+        self.poller.forget(stage)
+        await stage.close_device_async()
+
+    async def reconnect(self, name, stage):
+        """
+        Tries to reopen an offline Stage every retryInterval until it is
+        back.
+        """
+        try:
+            while not stage.online:
+                response = await stage.reopen_async()
+                if response != 'OK' and self.locate is not None and \
+                        time.time() - self.lastProbe > self.probeInterval:
+                    self.lastProbe = time.time()
+                    deviceID = await asyncio.get_event_loop().run_in_executor(None, self.locate, stage)
+                    if deviceID is not None:
+                        response = await stage.reopen_async(deviceID)
+
+                if response == 'OK':
+                    self.logger.info(f'{name}: {stage.name} reconnected')
+                    await self.poller.sample(stage)
+                else:
+                    self.logger.debug(f'{name}: reconnect failed: {response}')
+                    await asyncio.sleep(self.retryInterval)
+        finally:
+            del self.reconnecting[stage]
@@ -0,0 +1,185 @@
+# syncMove.py
+#
+# Time-synchronized multi-axis moves: 'goto,sync,a=..,b=..' (or offset).
+# Plain moves run every axis at its own speed, so they arrive one after
+# another. Here the move time of each axis is worked out from its
+# move_settings_t (Speed, Accel, Decel) and distance in steps, the slowest
+# axis keeps its speed and the others are slowed down so that they all
+# arrive together. The original speeds are restored once the axes stop.
+#
+# The move holds the lanes of all its axes from start to finish, so it
+# starts only once earlier commands to every axis are done, and later
+# ones wait until the speeds are restored. A 'stop' of an axis in a
+# synchronized move is not held up by this, as it goes ahead of the lanes,
+# and a move that has not sent its axes off yet is called off: see abort().
+
+import logging
+import asyncio
+import math
+import time
+
+from backgroundTasks import spawn
+
+def move_time(distance, speed, accel, decel):
+    """
+    Returns the time (s) of a trapezoidal move of distance steps with the
+    given top speed (steps/s), acceleration and deceleration (steps/s^2).
+    """
+    ramps = 1 / (2 * accel) + 1 / (2 * decel)
+    if distance >= speed * speed * ramps:
+        return distance / speed + speed * ramps
+    # triangular, never reaches top speed
+    peak = math.sqrt(distance / ramps)
+    return 2 * peak * ramps
+
+def scaled_speed(distance, duration, accel, decel):
+    """
+    Returns the top speed (steps/s) at which a move of distance steps
+    takes duration seconds, with the given acceleration and deceleration.
+    duration must be no less than the fastest possible move time.
+    """
+    ramps = 1 / (2 * accel) + 1 / (2 * decel)
+    # duration = distance/speed + speed*ramps, the lower root, written so
+    # it keeps its precision when ramps is tiny (Accel 0, see accel())
+    return 2 * distance / (duration + math.sqrt(max(0.0, duration * duration - 4 * ramps * distance)))
+
+class SyncMover:
+    def __init__(self, poller, submit, pollInterval=0.01):
+        """
+        Input:
+        - poller        StatusPoller, for positions and waiting out the move
+        - submit        CMDLoop.submit, to hold the axis lanes
+        - pollInterval  seconds between status reads of the moving axes
+        """
+        self.logger = logging.getLogger('stages')
+        self.poller = poller
+        self.submit = submit
+        self.pollInterval = pollInterval
+        # Stage -> number of times it was stopped, so a move can tell if
+        # one of its axes was stopped since it was queued
+        self.stops = {}
+
+    def submit_move(self, moves, relative):
+        """
+        Queues a synchronized move on the lanes of its axes.
+
+        Input:
+        - moves         [(name, stage, value)], value in real units
+        - relative      True for offsets, False for absolute targets
+
+        Output:
+        - awaitable that resolves to the reply string, once the moves are
+          sent: 'OK,<move time in s>'
+        """
+        loop = asyncio.get_event_loop()
+        arrived = [loop.create_future() for move in moves]
+        release = loop.create_future()
+        for (name, stage, val), lane in zip(moves, arrived):
+            self.submit(stage, self.hold, lane, release)
+        stops = [self.stops.get(stage, 0) for name, stage, val in moves]
+        return self.run(moves, relative, arrived, release, stops)
+
+    def abort(self, stages):
+        """
+        Records a stop of the given stages. A synchronized move queued
+        before it that has not sent its axes off yet then fails instead;
+        one already under way finishes as usual once its axes are IDLE.
+        Stopping the axes is left to the caller, ahead of the lanes the
+        moves are holding.
+        """
+        for stage in stages:
+            self.stops[stage] = self.stops.get(stage, 0) + 1
+
+    async def hold(self, arrived, release):
+        """
+        Lane job: signals that the lane has reached the move, then keeps the
+        lane until it is released.
+        """
+        arrived.set_result(None)
+        await release
+
+    async def run(self, moves, relative, arrived, release, stops):
+        await asyncio.gather(*arrived)
+        try:
+            plans = []
+            for name, stage, val in moves:
+                response, stageStatus = await self.poller.sample(stage)
+                self.check(response)
+                response, mvst = await stage.get_move_settings_async()
+                self.check(response)
+
+                if relative:
+                    target = stageStatus.encPosition + val / stage.conversionFactor
+                else:
+                    target = val / stage.conversionFactor
+                plans.append((name, stage, target, abs(target - stageStatus.encPosition), mvst))
+
+            duration = max([move_time(distance, self.speed(mvst), self.accel(mvst.Accel), self.accel(mvst.Decel))
+                            for name, stage, target, distance, mvst in plans if distance > 0], default=0.0)
+
+            changed = []
+            try:
+                for name, stage, target, distance, mvst in plans:
+                    if distance > 0:
+                        speed = scaled_speed(distance, duration, self.accel(mvst.Accel), self.accel(mvst.Decel))
+                        speed = max(speed, 1 / 256)  # slowest speed the controller takes
+                        if speed < self.speed(mvst):
+                            self.check(await stage.set_speed_async(speed))
+                            changed.append((stage, self.speed(mvst)))
+
+                if any(self.stops.get(stage, 0) != count for (name, stage, val), count in zip(moves, stops)):
+                    raise RuntimeError('stopped')
+                results = await asyncio.gather(*[stage.goto_steps_async(target)
+                                                 for name, stage, target, distance, mvst in plans])
+                for result in results:
+                    self.check(result)
+            except Exception:
+                await self.restore(changed)
+                raise
+
+        except Exception as e:
+            release.set_result(None)
+            retData = f'BAD,command failure: {e}'
+            self.logger.error(retData)
+            return retData
+
+        spawn(self.finish(plans, changed, release))
+        return f'OK,{duration:.3f}'
+
+    async def finish(self, plans, changed, release):
+        """
+        Waits for the axes to stop, restores their speeds and releases their
+        lanes.
+        """
+        try:
+            since = time.time()
+            for name, stage, target, distance, mvst in plans:
+                while True:
+                    await asyncio.sleep(self.pollInterval)
+                    response, stageStatus = await self.poller.sample(stage)
+                    self.check(response)
+                    if stageStatus.moveState == 'IDLE' and stageStatus.time > since:
+                        break
+        except Exception as e:
+            self.logger.error(f'synchronized move: {e}')
+        finally:
+            await self.restore(changed)
+            if not release.done():
+                release.set_result(None)
+
+    async def restore(self, changed):
+        for stage, speed in changed:
+            response = await stage.set_speed_async(speed)
+            if response != 'OK':
+                self.logger.error(f'{stage.name}: could not restore speed: {response}')
+
+    def check(self, response):
+        if response != 'OK':
+            raise RuntimeError(response)
+
+    def speed(self, mvst):
+        return mvst.Speed + mvst.uSpeed / 256
+
+    def accel(self, accel):
+        # an acceleration of 0 is treated as instantaneous
+        return accel if accel > 0 else 1e12
@@ -3,26 +3,168 @@
 # Aidan Gray
 # aidan.gray@idg.jhu.edu
 #
-# The Transmit Loop. It runs in parallel with the Command Handler and 
-# TCP Server loops. It monitors the Transmit Queue for new messages, 
-# then sends out the message to the correct client.
+# The Transmit Loop. It runs in parallel with the Command Handler and
+# TCP Server loops. It monitors the Transmit Queue for new messages,
+# then hands each message to the output channel of the correct client.
+# Every connection has its own bounded channel and writer task, so a slow
+# client never holds up replies to the others. Messages are text replies,
+# or already packed frames (bytes) for binary connections.
 
 import logging
+import asyncio
+import time
+from collections import deque
+
+POLICIES = ('drop', 'coalesce', 'disconnect')
+
+# longer messages (ie. capture dumps) are logged by size only
+LOG_LENGTH = 200
+
+class ClientChannel:
+    """
+    The output queue and writer task of one connection. When the client
+    falls behind, the policy decides what happens to new messages:
+    - drop          Once the queue is full, new messages are dropped
+    - coalesce      Once the queue is full, a new reply replaces a queued
+                    reply to the same query (same kind); other messages
+                    are dropped
+    - disconnect    Once the queue is full, the client is disconnected
+    """
+    def __init__(self, writer, maxQueue, policy):
+        self.logger = logging.getLogger('stages')
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.queue = deque()
+        self.ready = asyncio.Event()
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.maxDepth = 0
+        self.drainTime = 0.0
+        self.maxDrainTime = 0.0
+
+        self.task = asyncio.create_task(self.write_loop())
+
+    def put(self, msg, kind=None):
+        """
+        Queues a message. kind marks messages that may be coalesced: a
+        newer reply to the same query, ie. 'status,a'.
+        """
+        if len(self.queue) >= self.maxQueue and self.policy == 'coalesce' and kind is not None:
+            for i, (queuedMsg, queuedKind) in enumerate(self.queue):
+                if queuedKind == kind:
+                    del self.queue[i]
+                    self.coalesced += 1
+                    break
+
+        if len(self.queue) >= self.maxQueue:
+            if self.policy == 'disconnect':
+                self.logger.warning(f'Warning: disconnecting slow client {self.addr!r}')
+                self.close()
+            else:
+                self.dropped += 1
+            return
+
+        self.queue.append((msg, kind))
+        self.maxDepth = max(self.maxDepth, len(self.queue))
+        self.ready.set()
+
+    async def write_loop(self):
+        while not self.writer.is_closing():
+            if len(self.queue) == 0:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            msg, kind = self.queue.popleft()
+            if len(msg) <= LOG_LENGTH:
+                self.logger.info(f'sending: {msg!r} to {self.addr!r}')
+            else:
+                self.logger.info(f'sending: {len(msg)} bytes to {self.addr!r}')
+            if isinstance(msg, str):
+                msg = msg.encode()
+
+            startTime = time.perf_counter()
+            try:
+                self.writer.write(msg)
+                await self.writer.drain()
+            except ConnectionError as e:
+                self.logger.warning(f'Warning: peer disconnected')
+                break
+            drainTime = time.perf_counter() - startTime
+
+            self.sent += 1
+            self.drainTime += drainTime
+            self.maxDrainTime = max(self.maxDrainTime, drainTime)
+
+    def close(self):
+        self.queue.clear()
+        if not self.writer.is_closing():
+            self.writer.close()
+        self.ready.set()
+
+    def stats(self):
+        """
+        Returns the counters of this channel as a single line
+        """
+        if self.sent != 0:
+            drainAvg = 1000 * self.drainTime / self.sent
+        else:
+            drainAvg = 0.0
+        return (f'{self.addr!r}: policy={self.policy}, depth={len(self.queue)}, '
+                f'maxDepth={self.maxDepth}, sent={self.sent}, dropped={self.dropped}, '
+                f'coalesced={self.coalesced}, drainAvg={drainAvg:.3f}ms, '
+                f'drainMax={1000*self.maxDrainTime:.3f}ms')
 
 class Transmitter:
-    def __init__(self, qXmit):
+    def __init__(self, qXmit, maxQueue=100, policy='drop'):
         self.logger = logging.getLogger('stages')
         self.qXmit = qXmit
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.channels = {}
 
     async def start(self):
         while True:
-            cmd = await self.qXmit.get()  
+            cmd = await self.qXmit.get()
             writer = cmd[0]
             msg = cmd[1]
+            # optional third item: the kind of message, for coalescing
+            kind = cmd[2] if len(cmd) > 2 else None
+
             if not writer.is_closing():
-                addr = writer.get_extra_info('peername')
-                self.logger.info(f'sending: {msg!r} to {addr!r}')
-                writer.write(msg.encode())
-                await writer.drain()
+                self.channel(writer).put(msg, kind)
             else:
-                self.logger.warn(f'Warning: peer disconnected')
\ No newline at end of file
+                self.logger.warning(f'Warning: peer disconnected')
+
+    def channel(self, writer):
+        """
+        Returns the output channel of a connection, opening it if needed.
+        """
+        channel = self.channels.get(writer)
+        if channel is None:
+            # forget channels of connections that have since closed
+            for closed in [w for w in self.channels if w.is_closing()]:
+                self.channels.pop(closed).close()
+
+            channel = ClientChannel(writer, self.maxQueue, self.policy)
+            self.channels[writer] = channel
+        return channel
+
+    def set_policy(self, writer, policy):
+        """
+        Sets the slow client policy of one connection.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'unknown policy {policy!r}')
+        self.channel(writer).policy = policy
+
+    def stats(self):
+        """
+        Returns the counters of every open channel, one line each
+        """
+        return [channel.stats() for writer, channel in self.channels.items()
+                if not writer.is_closing()]
@@ -0,0 +1,55 @@
+# ximcDtypes.py
+#
+# NumPy structured dtypes with the memory layout of the libximc structs
+# used for telemetry, so libximc can write a read straight into one row of
+# a preallocated record array: no struct per read and no field by field
+# conversion to Python objects. Whole runs of samples can then be sliced,
+# saved or handed to a ring buffer as contiguous arrays.
+#
+#   records = np.zeros(1000, dtype=STATUS_RECORD_DTYPE)
+#   stage.read_status_into(records, i)
+#   records['status']['EncPosition'][:i + 1]
+#
+# The dtypes are taken from the pyximc ctypes structs themselves, so they
+# follow the wrapper when libximc is updated.
+
+from ctypes import *
+import numpy as np
+
+import ximcPath
+from pyximc import status_t, get_position_t, measurements_t
+
+STATUS_DTYPE = np.dtype(status_t)
+POSITION_DTYPE = np.dtype(get_position_t)
+MEASUREMENTS_DTYPE = np.dtype(measurements_t)
+
+# one timestamped sample: time is time.time() at the read
+STATUS_RECORD_DTYPE = np.dtype([('time', 'f8'), ('status', STATUS_DTYPE)], align=True)
+POSITION_RECORD_DTYPE = np.dtype([('time', 'f8'), ('position', POSITION_DTYPE)], align=True)
+MEASUREMENTS_RECORD_DTYPE = np.dtype([('time', 'f8'), ('measurements', MEASUREMENTS_DTYPE)], align=True)
+
+for structType, dtype in ((status_t, STATUS_DTYPE), (get_position_t, POSITION_DTYPE),
+                          (measurements_t, MEASUREMENTS_DTYPE)):
+    if dtype.itemsize != sizeof(structType):
+        raise ImportError(f'{structType.__name__}: dtype does not match the struct')
+
+def struct_ref(records, index, field, structType):
+    """
+    Returns a byref pointer to records[index][field], as the struct
+    libximc writes.
+
+    Input:
+    - records       1-D C-contiguous array of a *_RECORD_DTYPE
+    - index         row to point at
+    - field         name of the struct field of the record, ie. 'status'
+    - structType    the pyximc struct of that field
+    """
+    if records.ndim != 1 or not records.flags['C_CONTIGUOUS']:
+        raise ValueError('records must be a 1-D contiguous array')
+    fields = records.dtype.fields or {}
+    if field not in fields or fields[field][0] != np.dtype(structType):
+        raise ValueError(f'{field} is not a {structType.__name__}')
+    if not 0 <= index < len(records):
+        raise IndexError(f'record {index} out of range')
+    offset = index * records.itemsize + fields[field][1]
+    return byref(structType.from_buffer(records, offset))
@@ -0,0 +1,13 @@
+# ximcPath.py
+#
+# Puts the pyximc wrapper that ships with libximc on sys.path. Every module
+# that imports pyximc imports this first, so it does not matter which of
+# them is loaded first.
+
+import os
+import sys
+
+XIMC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ximc-2.13.3', 'ximc')
+ximcPackageDir = os.path.join(XIMC_DIR, 'crossplatform', 'wrappers', 'python')
+if ximcPackageDir not in sys.path:
+    sys.path.append(ximcPackageDir)
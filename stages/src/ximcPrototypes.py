@@ -0,0 +1,181 @@
+# ximcPrototypes.py
+#
+# GENERATED by genPrototypes.py from ximc.h, do not edit.
+#
+# declare(lib) sets argtypes/restype on every libximc function, so
+# ctypes converts arguments with the declared types instead of
+# guessing, and returns them at full width. This is for correct
+# types, not speed: declared calls are no faster (see benchXimc.py).
+
+from ctypes import *
+from pyximc import *
+
+# name: (restype, argtypes), argtypes None where not declared
+PROTOTYPES = {
+    'set_feedback_settings': (c_int, [c_int, POINTER(feedback_settings_t)]),
+    'get_feedback_settings': (c_int, [c_int, POINTER(feedback_settings_t)]),
+    'set_home_settings': (c_int, [c_int, POINTER(home_settings_t)]),
+    'set_home_settings_calb': (c_int, [c_int, POINTER(home_settings_calb_t), POINTER(calibration_t)]),
+    'get_home_settings': (c_int, [c_int, POINTER(home_settings_t)]),
+    'get_home_settings_calb': (c_int, [c_int, POINTER(home_settings_calb_t), POINTER(calibration_t)]),
+    'set_move_settings': (c_int, [c_int, POINTER(move_settings_t)]),
+    'set_move_settings_calb': (c_int, [c_int, POINTER(move_settings_calb_t), POINTER(calibration_t)]),
+    'get_move_settings': (c_int, [c_int, POINTER(move_settings_t)]),
+    'get_move_settings_calb': (c_int, [c_int, POINTER(move_settings_calb_t), POINTER(calibration_t)]),
+    'set_engine_settings': (c_int, [c_int, POINTER(engine_settings_t)]),
+    'set_engine_settings_calb': (c_int, [c_int, POINTER(engine_settings_calb_t), POINTER(calibration_t)]),
+    'get_engine_settings': (c_int, [c_int, POINTER(engine_settings_t)]),
+    'get_engine_settings_calb': (c_int, [c_int, POINTER(engine_settings_calb_t), POINTER(calibration_t)]),
+    'set_entype_settings': (c_int, [c_int, POINTER(entype_settings_t)]),
+    'get_entype_settings': (c_int, [c_int, POINTER(entype_settings_t)]),
+    'set_power_settings': (c_int, [c_int, POINTER(power_settings_t)]),
+    'get_power_settings': (c_int, [c_int, POINTER(power_settings_t)]),
+    'set_secure_settings': (c_int, [c_int, POINTER(secure_settings_t)]),
+    'get_secure_settings': (c_int, [c_int, POINTER(secure_settings_t)]),
+    'set_edges_settings': (c_int, [c_int, POINTER(edges_settings_t)]),
+    'set_edges_settings_calb': (c_int, [c_int, POINTER(edges_settings_calb_t), POINTER(calibration_t)]),
+    'get_edges_settings': (c_int, [c_int, POINTER(edges_settings_t)]),
+    'get_edges_settings_calb': (c_int, [c_int, POINTER(edges_settings_calb_t), POINTER(calibration_t)]),
+    'set_pid_settings': (c_int, [c_int, POINTER(pid_settings_t)]),
+    'get_pid_settings': (c_int, [c_int, POINTER(pid_settings_t)]),
+    'set_sync_in_settings': (c_int, [c_int, POINTER(sync_in_settings_t)]),
+    'set_sync_in_settings_calb': (c_int, [c_int, POINTER(sync_in_settings_calb_t), POINTER(calibration_t)]),
+    'get_sync_in_settings': (c_int, [c_int, POINTER(sync_in_settings_t)]),
+    'get_sync_in_settings_calb': (c_int, [c_int, POINTER(sync_in_settings_calb_t), POINTER(calibration_t)]),
+    'set_sync_out_settings': (c_int, [c_int, POINTER(sync_out_settings_t)]),
+    'set_sync_out_settings_calb': (c_int, [c_int, POINTER(sync_out_settings_calb_t), POINTER(calibration_t)]),
+    'get_sync_out_settings': (c_int, [c_int, POINTER(sync_out_settings_t)]),
+    'get_sync_out_settings_calb': (c_int, [c_int, POINTER(sync_out_settings_calb_t), POINTER(calibration_t)]),
+    'set_extio_settings': (c_int, [c_int, POINTER(extio_settings_t)]),
+    'get_extio_settings': (c_int, [c_int, POINTER(extio_settings_t)]),
+    'set_brake_settings': (c_int, [c_int, POINTER(brake_settings_t)]),
+    'get_brake_settings': (c_int, [c_int, POINTER(brake_settings_t)]),
+    'set_control_settings': (c_int, [c_int, POINTER(control_settings_t)]),
+    'set_control_settings_calb': (c_int, [c_int, POINTER(control_settings_calb_t), POINTER(calibration_t)]),
+    'get_control_settings': (c_int, [c_int, POINTER(control_settings_t)]),
+    'get_control_settings_calb': (c_int, [c_int, POINTER(control_settings_calb_t), POINTER(calibration_t)]),
+    'set_joystick_settings': (c_int, [c_int, POINTER(joystick_settings_t)]),
+    'get_joystick_settings': (c_int, [c_int, POINTER(joystick_settings_t)]),
+    'set_ctp_settings': (c_int, [c_int, POINTER(ctp_settings_t)]),
+    'get_ctp_settings': (c_int, [c_int, POINTER(ctp_settings_t)]),
+    'set_uart_settings': (c_int, [c_int, POINTER(uart_settings_t)]),
+    'get_uart_settings': (c_int, [c_int, POINTER(uart_settings_t)]),
+    'set_calibration_settings': (c_int, [c_int, POINTER(calibration_settings_t)]),
+    'get_calibration_settings': (c_int, [c_int, POINTER(calibration_settings_t)]),
+    'set_controller_name': (c_int, [c_int, POINTER(controller_name_t)]),
+    'get_controller_name': (c_int, [c_int, POINTER(controller_name_t)]),
+    'set_nonvolatile_memory': (c_int, [c_int, POINTER(nonvolatile_memory_t)]),
+    'get_nonvolatile_memory': (c_int, [c_int, POINTER(nonvolatile_memory_t)]),
+    'set_emf_settings': (c_int, [c_int, POINTER(emf_settings_t)]),
+    'get_emf_settings': (c_int, [c_int, POINTER(emf_settings_t)]),
+    'set_engine_advansed_setup': (c_int, [c_int, POINTER(engine_advansed_setup_t)]),
+    'get_engine_advansed_setup': (c_int, [c_int, POINTER(engine_advansed_setup_t)]),
+    'set_extended_settings': (c_int, [c_int, POINTER(extended_settings_t)]),
+    'get_extended_settings': (c_int, [c_int, POINTER(extended_settings_t)]),
+    'command_stop': (c_int, [c_int]),
+    'command_power_off': (c_int, [c_int]),
+    'command_move': (c_int, [c_int, c_int, c_int]),
+    'command_move_calb': (c_int, [c_int, c_float, POINTER(calibration_t)]),
+    'command_movr': (c_int, [c_int, c_int, c_int]),
+    'command_movr_calb': (c_int, [c_int, c_float, POINTER(calibration_t)]),
+    'command_home': (c_int, [c_int]),
+    'command_left': (c_int, [c_int]),
+    'command_right': (c_int, [c_int]),
+    'command_loft': (c_int, [c_int]),
+    'command_sstp': (c_int, [c_int]),
+    'get_position': (c_int, [c_int, POINTER(get_position_t)]),
+    'get_position_calb': (c_int, [c_int, POINTER(get_position_calb_t), POINTER(calibration_t)]),
+    'set_position': (c_int, [c_int, POINTER(set_position_t)]),
+    'set_position_calb': (c_int, [c_int, POINTER(set_position_calb_t), POINTER(calibration_t)]),
+    'command_zero': (c_int, [c_int]),
+    'command_save_settings': (c_int, [c_int]),
+    'command_read_settings': (c_int, [c_int]),
+    'command_save_robust_settings': (c_int, [c_int]),
+    'command_read_robust_settings': (c_int, [c_int]),
+    'command_eesave_settings': (c_int, [c_int]),
+    'command_eeread_settings': (c_int, [c_int]),
+    'command_start_measurements': (c_int, [c_int]),
+    'get_measurements': (c_int, [c_int, POINTER(measurements_t)]),
+    'get_chart_data': (c_int, [c_int, POINTER(chart_data_t)]),
+    'get_serial_number': (c_int, [c_int, POINTER(c_uint)]),
+    'get_firmware_version': (c_int, [c_int, POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)]),
+    'service_command_updf': (c_int, [c_int]),
+    'set_serial_number': (c_int, [c_int, POINTER(serial_number_t)]),
+    'get_analog_data': (c_int, [c_int, POINTER(analog_data_t)]),
+    'get_debug_read': (c_int, [c_int, POINTER(debug_read_t)]),
+    'set_debug_write': (c_int, [c_int, POINTER(debug_write_t)]),
+    'set_stage_name': (c_int, [c_int, POINTER(stage_name_t)]),
+    'get_stage_name': (c_int, [c_int, POINTER(stage_name_t)]),
+    'set_stage_information': (c_int, [c_int, POINTER(stage_information_t)]),
+    'get_stage_information': (c_int, [c_int, POINTER(stage_information_t)]),
+    'set_stage_settings': (c_int, [c_int, POINTER(stage_settings_t)]),
+    'get_stage_settings': (c_int, [c_int, POINTER(stage_settings_t)]),
+    'set_motor_information': (c_int, [c_int, POINTER(motor_information_t)]),
+    'get_motor_information': (c_int, [c_int, POINTER(motor_information_t)]),
+    'set_motor_settings': (c_int, [c_int, POINTER(motor_settings_t)]),
+    'get_motor_settings': (c_int, [c_int, POINTER(motor_settings_t)]),
+    'set_encoder_information': (c_int, [c_int, POINTER(encoder_information_t)]),
+    'get_encoder_information': (c_int, [c_int, POINTER(encoder_information_t)]),
+    'set_encoder_settings': (c_int, [c_int, POINTER(encoder_settings_t)]),
+    'get_encoder_settings': (c_int, [c_int, POINTER(encoder_settings_t)]),
+    'set_hallsensor_information': (c_int, [c_int, POINTER(hallsensor_information_t)]),
+    'get_hallsensor_information': (c_int, [c_int, POINTER(hallsensor_information_t)]),
+    'set_hallsensor_settings': (c_int, [c_int, POINTER(hallsensor_settings_t)]),
+    'get_hallsensor_settings': (c_int, [c_int, POINTER(hallsensor_settings_t)]),
+    'set_gear_information': (c_int, [c_int, POINTER(gear_information_t)]),
+    'get_gear_information': (c_int, [c_int, POINTER(gear_information_t)]),
+    'set_gear_settings': (c_int, [c_int, POINTER(gear_settings_t)]),
+    'get_gear_settings': (c_int, [c_int, POINTER(gear_settings_t)]),
+    'set_accessories_settings': (c_int, [c_int, POINTER(accessories_settings_t)]),
+    'get_accessories_settings': (c_int, [c_int, POINTER(accessories_settings_t)]),
+    'get_bootloader_version': (c_int, [c_int, POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)]),
+    'get_init_random': (c_int, [c_int, POINTER(init_random_t)]),
+    'get_globally_unique_identifier': (c_int, [c_int, POINTER(globally_unique_identifier_t)]),
+    'goto_firmware': (c_int, [c_int, POINTER(c_uint8)]),
+    'has_firmware': (c_int, [c_char_p, POINTER(c_uint8)]),
+    'command_update_firmware': (c_int, [c_char_p, POINTER(c_uint8), c_uint32]),
+    'write_key': (c_int, [c_char_p, POINTER(c_uint8)]),
+    'command_reset': (c_int, [c_int]),
+    'command_clear_fram': (c_int, [c_int]),
+    'open_device': (c_int, [c_char_p]),
+    'close_device': (c_int, [POINTER(c_int)]),
+    'load_correction_table': (c_int, [POINTER(c_int), c_char_p]),
+    'set_correction_table': (c_int, [c_int, c_char_p]),
+    'probe_device': (c_int, [c_char_p]),
+    'set_bindy_key': (c_int, [c_char_p]),
+    'enumerate_devices': (POINTER(device_enumeration_t), [c_int, c_char_p]),
+    'free_enumerate_devices': (c_int, [POINTER(device_enumeration_t)]),
+    'get_device_count': (c_int, [POINTER(device_enumeration_t)]),
+    'get_device_name': (c_char_p, [POINTER(device_enumeration_t), c_int]),
+    'get_enumerate_device_serial': (c_int, [POINTER(device_enumeration_t), c_int, POINTER(c_uint32)]),
+    'get_enumerate_device_information': (c_int, [POINTER(device_enumeration_t), c_int, POINTER(device_information_t)]),
+    'get_enumerate_device_controller_name': (c_int, [POINTER(device_enumeration_t), c_int, POINTER(controller_name_t)]),
+    'get_enumerate_device_stage_name': (c_int, [POINTER(device_enumeration_t), c_int, POINTER(stage_name_t)]),
+    'get_enumerate_device_network_information': (c_int, [POINTER(device_enumeration_t), c_int, POINTER(device_network_information_t)]),
+    'reset_locks': (c_int, []),
+    'ximc_fix_usbser_sys': (c_int, [c_char_p]),
+    'msec_sleep': (None, [c_uint]),
+    'ximc_version': (None, [c_char_p]),
+    'logging_callback_stderr_wide': (None, [c_int, c_wchar_p, c_void_p]),
+    'logging_callback_stderr_narrow': (None, [c_int, c_wchar_p, c_void_p]),
+    'set_logging_callback': (None, None),
+    'get_status': (c_int, [c_int, POINTER(status_t)]),
+    'get_status_calb': (c_int, [c_int, POINTER(status_calb_t), POINTER(calibration_t)]),
+    'get_device_information': (c_int, [c_int, POINTER(device_information_t)]),
+    'command_wait_for_stop': (c_int, [c_int, c_uint32]),
+    'command_homezero': (c_int, [c_int]),
+}
+
+def declare(lib):
+    """
+    Declares the prototypes on a loaded libximc, in place. Functions this
+    build of the library does not have are skipped.
+    """
+    for name, (restype, argtypes) in PROTOTYPES.items():
+        try:
+            func = getattr(lib, name)
+        except AttributeError:
+            continue
+        func.restype = restype
+        if argtypes is not None:
+            func.argtypes = argtypes
@@ -0,0 +1,9 @@
+# conftest.py
+#
+# The server modules import each other by name from stages/src, as main.py
+# is run from there, so the tests do the same.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
@@ -0,0 +1,49 @@
+# test_binaryProtocol.py
+
+import pytest
+
+from binaryProtocol import *
+
+def body(frame):
+    length, = LENGTH.unpack_from(frame)
+    assert length == len(frame) - LENGTH.size
+    return frame[LENGTH.size:]
+
+def test_axis_masks():
+    assert mask_axes(0b1010) == [1, 3]
+    assert mask_axes(0) == []
+    assert axes_mask([0, 2, 3]) == 0b1101
+    assert mask_axes(axes_mask([0, 1, 2, 3])) == [0, 1, 2, 3]
+
+def test_goto_request_round_trip():
+    frame = pack_request(OP_GOTO, 513, 0b0101, values=(1.5, -20.25))
+    request = unpack_request(body(frame))
+    assert request == (OP_GOTO, 513, 0b0101, 0, [1.5, -20.25])
+
+def test_status_request_has_no_values():
+    request = unpack_request(body(pack_request(OP_STATUS, 7, 0, FLAG_FRESH)))
+    assert request == (OP_STATUS, 7, 0, FLAG_FRESH, [])
+
+def test_status_reply_round_trip():
+    records = [(STATE_IDLE, 12.5), (STATE_BUSY, -3.0)]
+    frame = pack_reply(OP_STATUS, 65535, RESULT_OK, 0b0011, records)
+    reply = unpack_reply(body(frame))
+    assert reply == (OP_STATUS, 65535, RESULT_OK, 0b0011, records)
+
+def test_stop_reply_round_trip():
+    frame = pack_reply(OP_STOP, 3, RESULT_BAD, 0b1001, [RESULT_OK, RESULT_BAD])
+    reply = unpack_reply(body(frame))
+    assert reply == (OP_STOP, 3, RESULT_BAD, 0b1001, [RESULT_OK, RESULT_BAD])
+
+def test_truncated_goto_is_malformed():
+    truncated = body(pack_request(OP_GOTO, 9, 0b0011, values=(1.0, 2.0)))[:-1]
+    with pytest.raises(ValueError):
+        unpack_request(truncated)
+
+def test_malformed_request_gets_bad_reply_with_its_tag():
+    truncated = body(pack_request(OP_OFFSET, 42, 0b0001, values=(1.0,)))[:-4]
+    reply = unpack_reply(body(reject_request(truncated)))
+    assert reply == (OP_OFFSET, 42, RESULT_BAD, 0, [])
+
+def test_short_frame_is_dropped():
+    assert reject_request(b'\x01\x02') is None
@@ -0,0 +1,51 @@
+# test_positionHistory.py
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from positionHistory import PositionHistory
+
+def sample(time, position, moveState='IDLE'):
+    return SimpleNamespace(time=time, stepPosition=10 * position, encPosition=int(100 * position),
+                           position=position, moveState=moveState)
+
+def history():
+    history = PositionHistory(10)
+    history.append(sample(1.0, 0.0, 'BUSY'))
+    history.append(sample(2.0, 1.0, 'BUSY'))
+    history.append(sample(3.0, 1.0))
+    return history
+
+def test_at_interpolates_between_samples():
+    result = history().at([1.0, 1.25, 2.5, 3.0])
+    assert np.allclose(result['position'], [0.0, 0.25, 1.0, 1.0])
+    assert np.allclose(result['stepPosition'], [0.0, 2.5, 10.0, 10.0])
+    assert list(result['encPosition']) == [0, 25, 100, 100]
+    assert list(result['time']) == [1.0, 1.25, 2.5, 3.0]
+
+def test_at_takes_busy_from_the_sample_before():
+    result = history().at([1.5, 2.0, 2.9, 3.0])
+    assert list(result['busy']) == [True, True, True, False]
+
+def test_at_outside_the_history_is_nan():
+    result = history().at([0.5, 3.5])
+    assert np.isnan(result['position']).all()
+    assert np.isnan(result['stepPosition']).all()
+
+def test_at_with_no_history():
+    result = PositionHistory(10).at([1.0])
+    assert np.isnan(result['position'][0])
+
+def test_window_is_inclusive():
+    samples = history().window(1.0, 2.0)
+    assert list(samples['time']) == [1.0, 2.0]
+    assert len(history().window(1.1, 1.9)) == 0
+    assert len(history().window(0.0, 10.0)) == 3
+
+def test_history_keeps_the_latest_samples():
+    history = PositionHistory(2)
+    for i in range(5):
+        history.append(sample(float(i), float(i)))
+    assert len(history) == 2
+    assert list(history.window(0.0, 10.0)['time']) == [3.0, 4.0]
@@ -0,0 +1,56 @@
+# test_ringBuffer.py
+
+import numpy as np
+
+from ringBuffer import RingBuffer
+
+DTYPE = np.dtype([('time', 'f8'), ('value', 'i4')])
+
+def records(start, stop):
+    data = np.zeros(stop - start, dtype=DTYPE)
+    data['time'] = np.arange(start, stop)
+    data['value'] = np.arange(start, stop)
+    return data
+
+def test_append_keeps_order_until_full():
+    buffer = RingBuffer(4, DTYPE)
+    for i in range(3):
+        buffer.append((i, i))
+    assert len(buffer) == 3
+    assert list(buffer.array()['value']) == [0, 1, 2]
+
+def test_append_wraps_around_dropping_the_oldest():
+    buffer = RingBuffer(4, DTYPE)
+    for i in range(10):
+        buffer.append((i, i))
+    assert len(buffer) == 4
+    assert list(buffer.array()['value']) == [6, 7, 8, 9]
+
+def test_extend_across_the_end():
+    buffer = RingBuffer(5, DTYPE)
+    buffer.extend(records(0, 3))
+    buffer.extend(records(3, 7))
+    assert len(buffer) == 5
+    assert list(buffer.array()['value']) == [2, 3, 4, 5, 6]
+
+def test_extend_with_more_than_the_size():
+    buffer = RingBuffer(4, DTYPE)
+    buffer.append((0, 0))
+    buffer.extend(records(1, 11))
+    assert list(buffer.array()['value']) == [7, 8, 9, 10]
+
+def test_array_is_a_copy():
+    buffer = RingBuffer(4, DTYPE)
+    buffer.extend(records(0, 2))
+    data = buffer.array()
+    data['value'][:] = -1
+    assert list(buffer.array()['value']) == [0, 1]
+
+def test_clear():
+    buffer = RingBuffer(4, DTYPE)
+    buffer.extend(records(0, 6))
+    buffer.clear()
+    assert len(buffer) == 0
+    assert len(buffer.array()) == 0
+    buffer.append((9, 9))
+    assert list(buffer.array()['value']) == [9]
@@ -0,0 +1,29 @@
+# test_syncMove.py
+
+import pytest
+
+from syncMove import move_time, scaled_speed
+
+def test_trapezoidal_round_trip():
+    # reaches 1000 steps/s after 0.5 s, well short of the 5000 steps
+    duration = move_time(5000, 1000, 2000, 1000)
+    assert duration == pytest.approx(5000 / 1000 + 1000 * (1 / 4000 + 1 / 2000))
+    assert scaled_speed(5000, duration, 2000, 1000) == pytest.approx(1000)
+
+def test_triangular_move():
+    # 100 steps is too short to reach 1000 steps/s at 1000 steps/s^2
+    duration = move_time(100, 1000, 1000, 1000)
+    assert duration == pytest.approx(2 * (100 / 1000) ** 0.5)
+    peak = scaled_speed(100, duration, 1000, 1000)
+    assert peak < 1000
+    assert move_time(100, peak, 1000, 1000) == pytest.approx(duration)
+
+def test_slower_move_lowers_the_speed():
+    duration = move_time(5000, 1000, 2000, 2000)
+    speed = scaled_speed(5000, 2 * duration, 2000, 2000)
+    assert speed < 1000
+    assert move_time(5000, speed, 2000, 2000) == pytest.approx(2 * duration)
+
+def test_large_accel_approaches_constant_speed():
+    assert move_time(1000, 100, 1e12, 1e12) == pytest.approx(10)
+    assert scaled_speed(1000, 20, 1e12, 1e12) == pytest.approx(50)